@@ -0,0 +1,233 @@
+"""Bulk chart (and optionally prediction) generation from a file of birth records.
+
+    python run.py batch births.csv [--output batch-output] [--predict] [--restart]
+
+Input is CSV or JSON lines with the columns name, year, month, day, hour,
+minute, location and optionally country_code (or date DD-MM-YYYY and time
+HH:MM), or the legacy users.txt log. Records are read, rendered in the chart
+worker pool and written out one at a time, so memory stays flat whatever the
+input size. Results go to ``<output>/results.jsonl`` and the images to
+``<output>/charts/``; ``<output>/done.txt`` lists the finished records and a
+new run skips them unless ``--restart`` is given. Failed records are not
+checkpointed, so they are retried on the next run.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import re
+import sys
+import time
+from datetime import datetime
+
+from charts import image_extension
+from gazetteer import normalize_string
+from interaction_store import parse_users_txt
+
+logger = logging.getLogger(__name__)
+
+
+def read_records(path):
+    """Yield ``(record_id, fields)`` from a CSV, JSON lines or users.txt file."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        with open(path, newline='', encoding='utf-8') as records_file:
+            for i, row in enumerate(csv.DictReader(records_file)):
+                yield str(row.get('id') or i), row
+    elif extension in ('.jsonl', '.ndjson', '.json'):
+        with open(path, encoding='utf-8') as records_file:
+            for i, line in enumerate(records_file):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    row = {}
+                yield str(row.get('id', i)), row
+    else:
+        for i, row in enumerate(parse_users_txt(path)):
+            yield str(i), row
+
+
+def count_records(path):
+    # Only used for the progress display, a cheap estimate is enough
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in ('.csv', '.jsonl', '.ndjson', '.json'):
+        return None
+    with open(path, 'rb') as records_file:
+        lines = sum(chunk.count(b'\n') for chunk in iter(lambda: records_file.read(1 << 20), b''))
+    return max(0, lines - 1) if extension == '.csv' else lines
+
+
+def normalize_record(fields, gazetteer, allow_online=False):
+    """Turn an input row into the ``user_data`` the bot builds, or raise ValueError."""
+    fields = {k.strip().lower(): (v.strip() if isinstance(v, str) else v) for k, v in fields.items() if k}
+    year, month, day = fields.get('year'), fields.get('month'), fields.get('day')
+    if not year and fields.get('date'):
+        parts = re.split(r'[-/]', fields['date'])
+        day, month, year = parts if len(parts[0]) <= 2 else reversed(parts)
+    hour, minute = fields.get('hour'), fields.get('minute')
+    if hour in (None, '') and fields.get('time'):
+        hour, _, minute = fields['time'].partition(':')
+    try:
+        birth = datetime(int(year), int(month), int(day), int(hour), int(minute or 0))
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"invalid birth date or time: {e}") from e
+    location = normalize_string(str(fields.get('location') or ''))
+    if not location:
+        raise ValueError("missing location")
+    country_code = str(fields.get('country_code') or '').upper() or None
+    coordinates = None
+    if fields.get('lat') not in (None, '') and fields.get('lng') not in (None, '') and fields.get('tz'):
+        coordinates = (float(fields['lng']), float(fields['lat']), fields['tz'])
+    else:
+        place = gazetteer.resolve(location, country_code)
+        if place:
+            country_code = place.country_code
+            coordinates = (place.lng, place.lat, place.tz_str)
+        elif not (country_code and allow_online):
+            raise ValueError(f"unknown location {location!r}")
+    user_data = {
+        'name': str(fields.get('name') or 'Anon')[:40],
+        'year': str(birth.year), 'month': str(birth.month), 'day': str(birth.day),
+        'hour': birth.hour, 'minute': birth.minute,
+        'location': location, 'country_code': country_code,
+    }
+    if coordinates:
+        user_data['coordinates'] = coordinates
+    return user_data
+
+
+class Progress:
+    def __init__(self, total=None, skipped=0, stream=sys.stderr):
+        self.total = total
+        self.skipped = skipped
+        self.ok = 0
+        self.failed = 0
+        self.stream = stream
+        self.started = time.perf_counter()
+
+    def line(self):
+        done = self.ok + self.failed
+        elapsed = time.perf_counter() - self.started
+        rate = done / elapsed if elapsed else 0
+        text = f"{done + self.skipped}"
+        if self.total:
+            text += f"/{self.total}"
+            if rate:
+                text += f" ETA {max(0, self.total - done - self.skipped) / rate:.0f}s"
+        return f"{text} | ok {self.ok} failed {self.failed} skipped {self.skipped} | {rate:.1f}/s"
+
+    async def run(self, interval=0.5):
+        tty = self.stream.isatty()
+        while True:
+            await asyncio.sleep(interval if tty else 10)
+            print(f"\r{self.line()}" if tty else self.line(), end='' if tty else '\n', file=self.stream, flush=True)
+
+
+def _load_done(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding='utf-8') as done_file:
+        return {line.rstrip('\n') for line in done_file if line.strip()}
+
+
+def _write_file(path, data):
+    with open(path, 'wb') as output_file:
+        output_file.write(data)
+
+
+async def run_batch(args, get_chart, gazetteer, predict=None, chart_slots=8, image_format='png'):
+    """Process every record of ``args.input``; returns the :class:`Progress` counters.
+
+    ``get_chart(user_data)`` returns ``(chart, image)`` like the bot's, the
+    image encoded as ``image_format``, and ``predict(name, location, chart)``
+    the prediction text. At most
+    ``chart_slots`` charts and ``args.llm_concurrency`` predictions are in
+    flight at once, which also bounds the records held in memory.
+    """
+    charts_dir = os.path.join(args.output, 'charts')
+    os.makedirs(charts_dir, exist_ok=True)
+    results_path = os.path.join(args.output, 'results.jsonl')
+    done_path = os.path.join(args.output, 'done.txt')
+    if args.restart:
+        for path in (results_path, done_path):
+            if os.path.exists(path):
+                os.remove(path)
+    done = _load_done(done_path)
+    progress = Progress(count_records(args.input))
+    chart_semaphore = asyncio.Semaphore(chart_slots)
+    llm_semaphore = asyncio.Semaphore(args.llm_concurrency)
+    in_flight = asyncio.Semaphore(chart_slots + (args.llm_concurrency if predict else 0))
+    tasks = set()
+
+    # Line buffered: a record is only listed in done.txt after its result line is on disk
+    with open(results_path, 'a', encoding='utf-8', buffering=1) as results_file, \
+            open(done_path, 'a', encoding='utf-8', buffering=1) as done_file:
+
+        async def process(record_id, fields):
+            started = time.perf_counter()
+            result = {'id': record_id}
+            try:
+                user_data = normalize_record(fields, gazetteer, args.allow_online)
+                result.update(name=user_data['name'], location=user_data['location'],
+                              country_code=user_data['country_code'])
+                async with chart_semaphore:
+                    chart, image = await get_chart(user_data)
+                if not chart:
+                    raise RuntimeError("chart generation failed")
+                result['chart'] = chart
+                if image is not None and not args.no_png:
+                    filename = f"{re.sub(r'[^A-Za-z0-9_.-]', '_', record_id)[:100]}.{image_extension(image_format)}"
+                    await asyncio.to_thread(_write_file, os.path.join(charts_dir, filename), image)
+                    result['png'] = os.path.join('charts', filename)
+                if predict is not None:
+                    async with llm_semaphore:
+                        result['prediction'] = await predict(user_data['name'], user_data['location'], chart)
+            except Exception as e:
+                result['error'] = f"{type(e).__name__}: {e}"
+            result['seconds'] = round(time.perf_counter() - started, 3)
+            results_file.write(json.dumps(result, ensure_ascii=False) + '\n')
+            if 'error' in result:
+                progress.failed += 1
+            else:
+                done_file.write(record_id + '\n')
+                progress.ok += 1
+
+        def finished(task):
+            tasks.discard(task)
+            in_flight.release()
+
+        reporter = asyncio.create_task(progress.run())
+        try:
+            for i, (record_id, fields) in enumerate(read_records(args.input)):
+                if args.limit and i >= args.limit:
+                    break
+                if record_id in done:
+                    progress.skipped += 1
+                    continue
+                await in_flight.acquire()
+                task = asyncio.create_task(process(record_id, fields))
+                tasks.add(task)
+                task.add_done_callback(finished)
+            await asyncio.gather(*tasks)
+        finally:
+            reporter.cancel()
+    print(f"\r{progress.line()}", file=sys.stderr)
+    return progress
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='run.py batch', description=__doc__.splitlines()[0])
+    parser.add_argument('input', help="CSV, JSON lines or users.txt file with birth records")
+    parser.add_argument('--output', default='batch-output', help="Directory for results.jsonl, charts/ and done.txt")
+    parser.add_argument('--predict', action='store_true', help="Also ask OpenAI for each prediction")
+    parser.add_argument('--llm-concurrency', type=int, default=4, help="Predictions requested at once")
+    parser.add_argument('--no-png', action='store_true', help="Only keep the chart text")
+    parser.add_argument('--restart', action='store_true', help="Ignore the checkpoint and start over")
+    parser.add_argument('--allow-online', action='store_true',
+                        help="Look up places missing from the gazetteer on GeoNames (needs country_code)")
+    parser.add_argument('--limit', type=int, help="Process only the first N records")
+    return parser.parse_args(argv)
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+"""End-to-end benchmark of the chart and prediction pipeline.
+
+Drives every stage of run.py over a fixed corpus of birth data seeded from
+users.txt, with a local stub in place of OpenAI, then simulates N concurrent
+users going through chart + prediction. Reports p50/p95/p99 per stage,
+throughput per concurrency level and peak RSS, and writes everything to a
+JSON file that can be compared with a previous run.
+
+    python benchmarks/bench_pipeline.py [--corpus-size 50] [--concurrency 1 4 16]
+                                        [--output results.json] [--baseline previous.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from stub_openai import StubOpenAI  # noqa: E402
+
+# run.py answers with one of these messages instead of raising when OpenAI fails
+PREDICTION_ERROR_PREFIX = "Error al obtener la predicción astrológica"
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(samples, errors=0):
+    return {
+        'count': len(samples),
+        'errors': errors,
+        'mean_ms': round(sum(samples) / len(samples) * 1e3, 3) if samples else None,
+        'p50_ms': round(percentile(samples, 50) * 1e3, 3) if samples else None,
+        'p95_ms': round(percentile(samples, 95) * 1e3, 3) if samples else None,
+        'p99_ms': round(percentile(samples, 99) * 1e3, 3) if samples else None,
+    }
+
+
+def load_corpus(users_path, size, seed, gazetteer):
+    from interaction_store import parse_users_txt
+    base = []
+    for record in parse_users_txt(users_path):
+        try:
+            day, month, year = (int(v) for v in record['date'].split('-'))
+            hour, minute = (int(v) for v in record['time'].split(':'))
+        except (KeyError, ValueError):
+            continue
+        place = gazetteer.resolve(record.get('location', ''))
+        if place is None:
+            continue
+        base.append({
+            'name': record.get('name', 'Anon'), 'year': str(year), 'month': str(month), 'day': str(day),
+            'hour': hour, 'minute': minute, 'raw_location': record['location'],
+            'country_code': place.country_code, 'coordinates': (place.lng, place.lat, place.tz_str),
+        })
+    if not base:
+        raise SystemExit(f"No usable birth records in {users_path}")
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(size):
+        entry = dict(base[i % len(base)])
+        if i >= len(base):
+            # Later passes shift the minute so every chart is really computed
+            entry['minute'] = rng.randrange(60)
+        corpus.append(entry)
+    return corpus
+
+
+def returned_none(result):
+    return result is None
+
+
+def chart_failed(result):
+    # create_astrological_chart returns (None, None) instead of raising
+    return result is None or result[0] is None
+
+
+def prediction_failed(result):
+    return result is None or result.startswith(PREDICTION_ERROR_PREFIX)
+
+
+class StageTimer:
+    """Times each stage; calls that raise or whose result ``failed`` are errors, kept out of the percentiles."""
+
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+
+    def _done(self, stage, started, result, failed):
+        if failed(result):
+            self._failed(stage, f"returned {result!r:.80}")
+            return None
+        self.samples.setdefault(stage, []).append(time.perf_counter() - started)
+        return result
+
+    def _failed(self, stage, reason):
+        self.errors[stage] = self.errors.get(stage, 0) + 1
+        print(f"  {stage} failed: {reason}", file=sys.stderr)
+
+    def record(self, stage, fn, *args, failed=returned_none):
+        started = time.perf_counter()
+        try:
+            result = fn(*args)
+        except Exception as e:
+            self._failed(stage, repr(e))
+            return None
+        return self._done(stage, started, result, failed)
+
+    async def record_async(self, stage, coro, failed=returned_none):
+        started = time.perf_counter()
+        try:
+            result = await coro
+        except Exception as e:
+            self._failed(stage, repr(e))
+            return None
+        return self._done(stage, started, result, failed)
+
+    def summary(self):
+        stages = set(self.samples) | set(self.errors)
+        return {stage: summarize(self.samples.get(stage, []), self.errors.get(stage, 0)) for stage in sorted(stages)}
+
+
+async def bench_stages(run, corpus, gazetteer):
+    from kerykeion import AstrologicalSubject, Report
+    import charts
+    from gazetteer import normalize_string
+    timer = StageTimer()
+    image_bytes = {}
+    for entry in corpus:
+        location = timer.record('normalize_string', normalize_string, entry['raw_location'])
+        timer.record('gazetteer_resolve', gazetteer.resolve, location)
+        chart, svg = timer.record('create_astrological_chart', charts.create_astrological_chart,
+                                  entry['name'], entry['year'], entry['month'], entry['day'], entry['hour'],
+                                  entry['minute'], location, entry['country_code'], entry['coordinates'],
+                                  failed=chart_failed) or (None, None)
+        lng, lat, tz_str = entry['coordinates']
+        subject = AstrologicalSubject(entry['name'], int(entry['year']), int(entry['month']), int(entry['day']),
+                                      entry['hour'], entry['minute'], location, entry['country_code'],
+                                      lng=lng, lat=lat, tz_str=tz_str, online=False)
+        timer.record('format_chart', charts.format_chart, Report(subject).get_full_report())
+        if svg:
+            timer.record('replace_css_variables', charts.replace_css_variables, svg, run.CHART_THEME)
+            for profile in (run.CHART_PREVIEW, run.CHART_HD):
+                # One profile at a time, so each is timed with its own SVG parse
+                rendered = timer.record(f'rasterize_chart.{profile.name}', charts.rasterize_chart_profiles, svg,
+                                        [(profile.scale, profile.image_format)], run.CHART_THEME)
+                if rendered is not None:
+                    image_bytes.setdefault(profile.name, []).append(len(rendered[0][0]))
+        if chart:
+            await timer.record_async('get_astrological_prediction',
+                                     run.get_astrological_prediction(entry['name'], location, chart),
+                                     failed=prediction_failed)
+
+            async def first_paragraph():
+                stream = run.stream_astrological_prediction(entry['name'], location, chart)
+                try:
+                    return await stream.__anext__()
+                finally:
+                    await stream.aclose()
+            await timer.record_async('prediction_first_paragraph', first_paragraph(), failed=prediction_failed)
+    sizes = {name: {'count': len(values), 'mean': round(sum(values) / len(values)), 'max': max(values)}
+             for name, values in image_bytes.items()}
+    return timer.summary(), sizes
+
+
+async def bench_concurrency(run, corpus, users):
+    # Each simulated user takes the next birth record and goes through the
+    # same chart + streamed prediction path as a reading of the engine
+    from gazetteer import normalize_string
+    queue = asyncio.Queue()
+    for entry in corpus:
+        queue.put_nowait(entry)
+    latencies = []
+    errors = 0
+
+    async def user():
+        nonlocal errors
+        while True:
+            try:
+                entry = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            user_data = dict(entry, location=normalize_string(entry['raw_location']))
+            started = time.perf_counter()
+            try:
+                chart, _ = await run.get_chart(user_data, run.CHART_PREVIEW)
+                if not chart:
+                    raise RuntimeError("chart generation failed")
+                async for paragraph in run.stream_astrological_prediction(user_data['name'], user_data['location'],
+                                                                           chart):
+                    if prediction_failed(paragraph):
+                        raise RuntimeError(paragraph)
+            except Exception as e:
+                errors += 1
+                print(f"  user failed: {e!r}", file=sys.stderr)
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user() for _ in range(users)))
+    elapsed = time.perf_counter() - started
+    result = summarize(latencies, errors)
+    result.update({'users': users, 'seconds': round(elapsed, 3),
+                   'charts_per_second': round(len(latencies) / elapsed, 3) if elapsed else None})
+    return result
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, encoding='utf-8') as baseline_file:
+        baseline = json.load(baseline_file)
+    print(f"\nComparison with {baseline_path} (p95):")
+    for stage, summary in results['stages'].items():
+        before = baseline.get('stages', {}).get(stage, {}).get('p95_ms')
+        after = summary.get('p95_ms')
+        if before and after:
+            print(f"  {stage:30s} {before:10.3f} ms -> {after:10.3f} ms ({(after - before) / before * 100:+.1f}%)")
+
+
+async def main(args):
+    stub = StubOpenAI(args.stub_latency, args.stub_tokens_per_second)
+    port = await stub.start()
+    # Configure run.py before importing it: stub endpoint, no caches unless asked
+    os.environ['OPENAI_BASE_URL'] = f"http://127.0.0.1:{port}/v1"
+    os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+    if not args.with_caches:
+        os.environ['CHART_CACHE_MAX_MB'] = '0'
+        os.environ['PREDICTION_CACHE_TTL'] = '0'
+    args.output = os.path.abspath(args.output)
+    args.users = os.path.abspath(args.users)
+    if args.baseline:
+        args.baseline = os.path.abspath(args.baseline)
+    os.chdir(ROOT)
+    import run
+    from gazetteer import load_gazetteer
+
+    run.configure_logging()
+    run.open_pipeline()
+    gazetteer = load_gazetteer(run.GAZETTEER_INDEX_PATH, run.GAZETTEER_SOURCES, run.GAZETTEER_PREFERRED_COUNTRIES)
+    corpus = load_corpus(args.users, args.corpus_size, args.seed, gazetteer)
+    print(f"Corpus: {len(corpus)} birth records from {args.users}")
+
+    results = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'corpus_size': len(corpus),
+            'seed': args.seed,
+            'chart_workers': run.chart_pool.max_workers,
+            'stub_latency': args.stub_latency,
+            'stub_tokens_per_second': args.stub_tokens_per_second,
+            'with_caches': args.with_caches,
+        },
+    }
+    print("Timing stages...")
+    results['stages'], results['image_bytes'] = await bench_stages(run, corpus, gazetteer)
+    results['concurrency'] = []
+    for users in args.concurrency:
+        print(f"Simulating {users} concurrent users...")
+        results['concurrency'].append(await bench_concurrency(run, corpus, users))
+
+    await run.prediction_client.aclose()
+    run.chart_pool.shutdown()
+    gazetteer.close()
+    await stub.close()
+    # ru_maxrss is in kilobytes on Linux; children are the chart pool workers
+    results['peak_rss_kb'] = {
+        'main': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'workers': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+    print(f"\n{'stage':30s} {'p50 ms':>10s} {'p95 ms':>10s} {'p99 ms':>10s} {'errors':>7s}")
+    for stage, summary in results['stages'].items():
+        print(f"{stage:30s} {summary['p50_ms'] or 0:10.3f} {summary['p95_ms'] or 0:10.3f} "
+              f"{summary['p99_ms'] or 0:10.3f} {summary['errors']:7d}")
+    for summary in results['concurrency']:
+        print(f"{summary['users']:3d} users: {summary['charts_per_second']} charts/s, "
+              f"p95 {summary['p95_ms']} ms, {summary['errors']} errors")
+    for profile, sizes in results['image_bytes'].items():
+        print(f"{profile} image: {sizes['mean']} bytes on average, {sizes['max']} at most")
+    print(f"Peak RSS: {results['peak_rss_kb']}")
+
+    with open(args.output, 'w', encoding='utf-8') as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"Results written to {args.output}")
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', default=os.path.join(ROOT, 'users.txt'), help="Birth data to seed the corpus")
+    parser.add_argument('--corpus-size', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1984)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--stub-latency', type=float, default=0.5, help="Stub OpenAI time to first byte")
+    parser.add_argument('--stub-tokens-per-second', type=float, default=200.0)
+    parser.add_argument('--with-caches', action='store_true', help="Keep the chart and prediction caches enabled")
+    parser.add_argument('--output', default=f"bench-pipeline-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    parser.add_argument('--baseline', help="Previous results file to compare against")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""Micro-benchmark of the chart theme substitution.
+
+Compares the old one ``str.replace`` per variable loop with the compiled
+single-pass :class:`themes.Theme` on real kerykeion output.
+
+    python benchmarks/bench_themes.py [--svg chart.svg] [--number 200]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from themes import DARK_VARIABLES, get_theme  # noqa: E402
+
+
+def legacy_replace_css_variables(svg_content):
+    # The previous implementation, kept here as the baseline
+    css_variables = dict(DARK_VARIABLES)
+    for var, value in css_variables.items():
+        svg_content = svg_content.replace(f"var({var})", value)
+    return svg_content
+
+
+def sample_svg():
+    from kerykeion import AstrologicalSubject, KerykeionChartSVG
+    subject = AstrologicalSubject("Asier", 1984, 6, 16, 22, 30, "Bilbao", "ES",
+                                  lng=-2.935, lat=43.263, tz_str="Europe/Madrid", online=False)
+    try:
+        chart = KerykeionChartSVG(subject, theme="dark", chart_language="ES")
+    except TypeError:
+        # kerykeion < 4.12 has no themes and emits no CSS variables
+        chart = KerykeionChartSVG(subject)
+    return chart.makeTemplate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--svg', help="SVG file to use instead of a freshly generated chart")
+    parser.add_argument('--number', type=int, default=200, help="Substitutions per timing run")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.svg:
+        with open(args.svg, encoding='utf-8') as svg_file:
+            svg_content = svg_file.read()
+    else:
+        svg_content = sample_svg()
+    references = svg_content.count('var(--kerykeion-')
+    print(f"SVG size: {len(svg_content)} chars, {references} variable references")
+    if not references:
+        print("Warning: this kerykeion version emits no CSS variables, timings only measure the scan")
+
+    theme = get_theme('dark')
+    assert theme.apply(svg_content) == legacy_replace_css_variables(svg_content), "outputs differ"
+
+    legacy = min(timeit.repeat(lambda: legacy_replace_css_variables(svg_content),
+                               number=args.number, repeat=args.repeat)) / args.number
+    compiled = min(timeit.repeat(lambda: theme.apply(svg_content),
+                                 number=args.number, repeat=args.repeat)) / args.number
+    print(f"str.replace loop: {legacy * 1e3:8.3f} ms per chart")
+    print(f"compiled theme:   {compiled * 1e3:8.3f} ms per chart")
+    print(f"speedup:          {legacy / compiled:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""Run whole conversations through the conversation engine with fake channels.
+
+Each simulated user talks to run.py's engine through a recording
+:class:`FakeChannel` instead of Telegram or Twilio, alternating between the
+channels given, so they all share the real chart pool, caches, scheduler and
+rate limits while OpenAI is replaced by the local stub. Reports the readings
+finished per channel, the time from the city to the chart preview and to the
+end of the reading, and the messages and images each channel sent.
+
+    python benchmarks/fake_channel.py [--users 20] [--channels telegram whatsapp]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from bench_pipeline import load_corpus, summarize  # noqa: E402
+from conversation import Channel  # noqa: E402
+from stub_openai import StubOpenAI  # noqa: E402
+
+REPEAT_QUESTION = '🌟'
+
+
+class FakeChannel(Channel):
+    """Records what the engine sends, as ``(chat_id, kind, payload)`` tuples in ``sent``.
+
+    ``latency`` seconds are spent on every send, like a round trip to the real API.
+    """
+
+    def __init__(self, name, latency=0.0):
+        self.name = name
+        self.latency = latency
+        self.sent = []
+        self._changed = asyncio.Condition()
+
+    async def _record(self, chat_id, kind, payload):
+        await asyncio.sleep(self.latency)
+        async with self._changed:
+            self.sent.append((chat_id, kind, payload))
+            self._changed.notify_all()
+
+    async def send_text(self, chat_id, text):
+        await self._record(chat_id, 'text', text)
+
+    async def send_image(self, chat_id, image, filename, caption=None, full_resolution=False):
+        await self._record(chat_id, 'image', {'filename': filename, 'bytes': len(image), 'caption': caption,
+                                              'full_resolution': full_resolution})
+
+    def messages(self, chat_id):
+        return [(kind, payload) for sent_to, kind, payload in self.sent if sent_to == chat_id]
+
+    async def wait_for(self, chat_id, predicate, timeout=120):
+        """Wait until ``predicate(kind, payload)`` holds for a message sent to ``chat_id``."""
+        async def matched():
+            async with self._changed:
+                await self._changed.wait_for(
+                    lambda: any(predicate(kind, payload) for kind, payload in self.messages(chat_id)))
+        await asyncio.wait_for(matched(), timeout)
+
+
+async def converse(engine, channel, chat_id, entry, results):
+    for text in ('/start', entry['name'], entry['year'], entry['month'], entry['day'],
+                 f"{entry['hour']:02d}:{entry['minute']:02d}"):
+        await engine.handle(channel, chat_id, chat_id, text)
+    started = time.perf_counter()
+    await engine.handle(channel, chat_id, chat_id, entry['raw_location'])
+    try:
+        await channel.wait_for(chat_id, lambda kind, payload: kind == 'image')
+        preview = time.perf_counter() - started
+        await channel.wait_for(chat_id, lambda kind, payload: kind == 'text' and payload.startswith(REPEAT_QUESTION))
+    except asyncio.TimeoutError:
+        results[channel.name]['errors'] += 1
+        return
+    results[channel.name]['preview'].append(preview)
+    results[channel.name]['reading'].append(time.perf_counter() - started)
+
+
+async def main(args):
+    stub = StubOpenAI(args.stub_latency, args.stub_tokens_per_second)
+    port = await stub.start()
+    # Configure run.py before importing it: stub endpoint, sessions in memory, no pause
+    # between messages and no caches unless asked
+    os.environ['OPENAI_BASE_URL'] = f"http://127.0.0.1:{port}/v1"
+    os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+    os.environ['PERSISTENCE_URL'] = ''
+    os.environ['MESSAGE_MIN_INTERVAL'] = '0'
+    if not args.with_caches:
+        os.environ['CHART_CACHE_MAX_MB'] = '0'
+        os.environ['PREDICTION_CACHE_TTL'] = '0'
+    args.users_file = os.path.abspath(args.users_file)
+    os.chdir(ROOT)
+    import run
+    from gazetteer import load_gazetteer
+
+    run.configure_logging()
+    run.open_bot()
+    run.gazetteer = load_gazetteer(run.GAZETTEER_INDEX_PATH, run.GAZETTEER_SOURCES, run.GAZETTEER_PREFERRED_COUNTRIES)
+    run.engine.log_interaction = None  # Keep fake readings out of interactions.sqlite
+    corpus = load_corpus(args.users_file, args.users, args.seed, run.gazetteer)
+    channels = [FakeChannel(name, args.send_latency) for name in args.channels]
+    results = {channel.name: {'preview': [], 'reading': [], 'errors': 0} for channel in channels}
+
+    started = time.perf_counter()
+    await asyncio.gather(*(converse(run.engine, channels[i % len(channels)], f"fake-{i}", entry, results)
+                           for i, entry in enumerate(corpus)))
+    elapsed = time.perf_counter() - started
+
+    await run.engine.close()
+    await run.release_pipeline()
+    await stub.close()
+    print(f"{len(corpus)} conversations in {elapsed:.2f}s, {run.chart_pool.max_workers} chart workers")
+    for channel in channels:
+        summary = results[channel.name]
+        preview, reading = summarize(summary['preview'], summary['errors']), summarize(summary['reading'])
+        texts = sum(kind == 'text' for _, kind, _ in channel.sent)
+        images = sum(kind == 'image' for _, kind, _ in channel.sent)
+        print(f"{channel.name:10s} {reading['count']} readings, {summary['errors']} errors | "
+              f"preview p50 {preview['p50_ms']} ms p95 {preview['p95_ms']} ms | "
+              f"reading p50 {reading['p50_ms']} ms p95 {reading['p95_ms']} ms | {texts} texts, {images} images")
+    return sum(summary['errors'] for summary in results.values())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20, help="Simulated users, each one runs a conversation")
+    parser.add_argument('--channels', nargs='+', default=['telegram', 'whatsapp'])
+    parser.add_argument('--users-file', default=os.path.join(ROOT, 'users.txt'), help="Birth data to seed the users")
+    parser.add_argument('--seed', type=int, default=1984)
+    parser.add_argument('--send-latency', type=float, default=0.05, help="Seconds each fake send takes")
+    parser.add_argument('--stub-latency', type=float, default=0.5, help="Stub OpenAI time to first byte")
+    parser.add_argument('--stub-tokens-per-second', type=float, default=200.0)
+    parser.add_argument('--with-caches', action='store_true', help="Keep the chart and prediction caches enabled")
+    sys.exit(1 if asyncio.run(main(parser.parse_args())) else 0)
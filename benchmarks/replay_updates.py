@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""POST recorded (or synthetic) Telegram updates to a local webhook.
+
+Start the bot in webhook mode without WEBHOOK_URL, so nothing is registered
+with Telegram, and replay updates against it:
+
+    WEBHOOK_PORT=8080 WEBHOOK_SECRET=s3cret python run.py
+    python benchmarks/replay_updates.py updates.jsonl --secret s3cret
+    python benchmarks/replay_updates.py --synthetic 500 --secret s3cret --concurrency 64
+
+Recorded files hold one update JSON object per line (or a JSON list). The
+synthetic mode runs full conversations (/start, name, date, time, city) for
+N different chats. Reports accepted updates per second and the status codes.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+import aiohttp
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+CONVERSATION = ['/start', 'Ana', '1990', '5', '3', '10:05', 'Madrid']
+
+
+def load_updates(paths):
+    for path in paths:
+        with open(path, encoding='utf-8') as updates_file:
+            text = updates_file.read().strip()
+        if text.startswith('['):
+            yield from json.loads(text)
+        else:
+            yield from (json.loads(line) for line in text.splitlines() if line.strip())
+
+
+def synthetic_updates(chats):
+    # One message per chat per step, so every chat walks the conversation in order
+    update_id = 0
+    for step, text in enumerate(CONVERSATION):
+        for chat_id in range(1, chats + 1):
+            update_id += 1
+            message = {
+                'message_id': step + 1,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private', 'first_name': f'Test {chat_id}'},
+                'from': {'id': chat_id, 'is_bot': False, 'first_name': f'Test {chat_id}'},
+                'text': text,
+            }
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+            yield {'update_id': update_id, 'message': message}
+
+
+async def replay(url, updates, secret, concurrency):
+    queue = asyncio.Queue()
+    for update in updates:
+        queue.put_nowait(update)
+    total = queue.qsize()
+    statuses = {}
+    headers = {SECRET_HEADER: secret} if secret else {}
+
+    # aiohttp rather than httpx: its client pool keeps up with many concurrent senders
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30)) as client:
+        async def sender():
+            while True:
+                try:
+                    update = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    async with client.post(url, json=update, headers=headers) as response:
+                        status = response.status
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    status = type(e).__name__
+                statuses[status] = statuses.get(status, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(sender() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    print(f"{total} updates in {elapsed:.2f}s ({total / elapsed:.0f} updates/s)")
+    print(f"Status codes: {statuses}")
+    return statuses
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('files', nargs='*', help="Recorded updates, JSON lines or a JSON list")
+    parser.add_argument('--url', default='http://127.0.0.1:8080/telegram')
+    parser.add_argument('--secret', help="Value of WEBHOOK_SECRET")
+    parser.add_argument('--synthetic', type=int, metavar='CHATS', help="Generate conversations for CHATS chats")
+    parser.add_argument('--concurrency', type=int, default=16)
+    args = parser.parse_args()
+    if not args.files and not args.synthetic:
+        parser.error("give recorded update files or --synthetic CHATS")
+    updates = list(synthetic_updates(args.synthetic) if args.synthetic else load_updates(args.files))
+    statuses = asyncio.run(replay(args.url, updates, args.secret, args.concurrency))
+    sys.exit(0 if set(statuses) == {200} else 1)
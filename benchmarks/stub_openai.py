@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""Local stand-in for the OpenAI chat completions endpoint.
+
+Answers ``POST /v1/chat/completions`` with a canned Spanish reading, either as
+one JSON response or as a server-sent event stream, after a configurable
+latency. Point the bot or the benchmarks at it with
+``OPENAI_BASE_URL=http://127.0.0.1:8089/v1``.
+
+    python benchmarks/stub_openai.py [--port 8089] [--latency 0.5] [--tokens-per-second 200]
+"""
+import argparse
+import asyncio
+import json
+import time
+
+PARAGRAPHS = [
+    "🌟 Ah, un Géminis... ¿cuál de tus dos personalidades está leyendo esto?",
+    "🔮 Tu Sol en la casa quinta habla de creatividad y de ganas de brillar, y la Luna en Escorpio añade intensidad a tus emociones.",
+    "💼 En el trabajo, Saturno te pide constancia: los resultados llegan, pero a su ritmo.",
+    "❤️ En el amor, Venus en trígono con Marte promete química, siempre que dejes el móvil un rato.",
+    "😜 Y recuerda: si algo sale mal, siempre puedes echarle la culpa a Mercurio retrógrado.",
+]
+CONTENT = '\n\n'.join(PARAGRAPHS)
+
+
+class StubOpenAI:
+    def __init__(self, latency=0.5, tokens_per_second=200.0):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.requests = 0
+        self._server = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            # Keep-alive: serve requests on the connection until the client closes it
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                if method != 'POST' or not path.endswith('/chat/completions'):
+                    self._write(writer, 404, b'{"error": "not found"}')
+                    await writer.drain()
+                    continue
+                self.requests += 1
+                payload = json.loads(body or b'{}')
+                await asyncio.sleep(self.latency)
+                if payload.get('stream'):
+                    await self._stream(writer, payload)
+                else:
+                    await asyncio.sleep(len(CONTENT.split()) / self.tokens_per_second)
+                    self._write(writer, 200, json.dumps(self._completion(payload)).encode('utf-8'))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _usage(self, payload):
+        prompt_tokens = sum(len(m.get('content', '').split()) for m in payload.get('messages', []))
+        completion_tokens = len(CONTENT.split())
+        return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens}
+
+    def _completion(self, payload):
+        return {
+            'id': 'chatcmpl-stub', 'object': 'chat.completion', 'created': int(time.time()),
+            'model': payload.get('model'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': CONTENT}, 'finish_reason': 'stop'}],
+            'usage': self._usage(payload),
+        }
+
+    def _write(self, writer, status, body, content_type='application/json'):
+        writer.write(
+            f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+            f"Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\n\r\n".encode('latin-1') + body)
+
+    async def _stream(self, writer, payload):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+
+        def send(event):
+            data = f"data: {event}\n\n".encode('utf-8')
+            writer.write(f"{len(data):x}\r\n".encode('latin-1') + data + b"\r\n")
+
+        delay = 1 / self.tokens_per_second
+        for word in CONTENT.split(' '):
+            chunk = {'id': 'chatcmpl-stub', 'object': 'chat.completion.chunk', 'model': payload.get('model'),
+                     'choices': [{'index': 0, 'delta': {'content': word + ' '}}]}
+            send(json.dumps(chunk))
+            await writer.drain()
+            await asyncio.sleep(delay)
+        send(json.dumps({'id': 'chatcmpl-stub', 'object': 'chat.completion.chunk', 'choices': [],
+                         'usage': self._usage(payload)}))
+        send('[DONE]')
+        writer.write(b"0\r\n\r\n")
+
+
+async def serve(host, port, latency, tokens_per_second):
+    stub = StubOpenAI(latency, tokens_per_second)
+    port = await stub.start(host, port)
+    print(f"Stub OpenAI listening on http://{host}:{port}/v1")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.5, help="Seconds before the first byte")
+    parser.add_argument('--tokens-per-second', type=float, default=200.0)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.latency, args.tokens_per_second))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""In-memory stand-in for a Redis server, enough for RedisPersistence.
+
+Speaks RESP2 and implements PING, SELECT, CLIENT, GET, SET, the hash
+commands (HGET, HSET, HDEL, HGETALL, HLEN), DEL, FLUSHALL and optimistic transactions
+(WATCH, UNWATCH, MULTI, EXEC, DISCARD). Point the bot at it with
+``PERSISTENCE_URL=redis://127.0.0.1:6399/0``.
+
+    python benchmarks/stub_redis.py [--port 6399]
+"""
+import argparse
+import asyncio
+
+
+class StubRedis:
+    def __init__(self):
+        self.strings = {}
+        self.hashes = {}
+        self.changes = {}  # name -> times the key was modified, for WATCH
+        self.commands = 0
+        self._server = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _read_command(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.decode('utf-8').split()  # Inline command, e.g. from telnet
+        args = []
+        for _ in range(int(line[1:])):
+            size = int((await reader.readline())[1:])
+            args.append((await reader.readexactly(size + 2))[:-2].decode('utf-8'))
+        return args
+
+    async def _handle(self, reader, writer):
+        watched = {}  # name -> changes when WATCH was sent
+        queued = None  # Commands after MULTI
+        try:
+            while True:
+                args = await self._read_command(reader)
+                if args is None:
+                    break
+                if not args:
+                    continue
+                self.commands += 1
+                command = args[0].upper()
+                if command == 'WATCH':
+                    watched.update((name, self.changes.get(name, 0)) for name in args[1:])
+                    reply = b'+OK\r\n'
+                elif command == 'UNWATCH':
+                    watched.clear()
+                    reply = b'+OK\r\n'
+                elif command == 'MULTI':
+                    queued = []
+                    reply = b'+OK\r\n'
+                elif command == 'DISCARD':
+                    queued = None
+                    watched.clear()
+                    reply = b'+OK\r\n'
+                elif command == 'EXEC':
+                    if any(self.changes.get(name, 0) != seen for name, seen in watched.items()):
+                        reply = b'*-1\r\n'  # Aborted, a watched key changed
+                    else:
+                        replies = [self._execute(queued_args[0].upper(), queued_args[1:]) for queued_args in queued or ()]
+                        reply = f"*{len(replies)}\r\n".encode() + b''.join(replies)
+                    queued = None
+                    watched.clear()
+                elif queued is not None:
+                    queued.append(args)
+                    reply = b'+QUEUED\r\n'
+                else:
+                    reply = self._execute(command, args[1:])
+                writer.write(reply)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _execute(self, command, args):
+        if command == 'PING':
+            return b'+PONG\r\n'
+        if command in ('SELECT', 'CLIENT'):
+            return b'+OK\r\n'
+        if command == 'FLUSHALL':
+            for name in [*self.strings, *self.hashes]:
+                self._changed(name)
+            self.strings.clear()
+            self.hashes.clear()
+            return b'+OK\r\n'
+        if command == 'DEL':
+            for name in args:
+                self._changed(name)
+            return _integer(sum(self.strings.pop(name, None) is not None or self.hashes.pop(name, None) is not None
+                                for name in args))
+        if command == 'GET':
+            return _bulk(self.strings.get(args[0]))
+        if command == 'SET':
+            self._changed(args[0])
+            self.strings[args[0]] = args[1]
+            return b'+OK\r\n'
+        if command == 'HGET':
+            return _bulk(self.hashes.get(args[0], {}).get(args[1]))
+        if command == 'HSET':
+            self._changed(args[0])
+            fields = self.hashes.setdefault(args[0], {})
+            added = 0
+            for field, value in zip(args[1::2], args[2::2]):
+                added += field not in fields
+                fields[field] = value
+            return _integer(added)
+        if command == 'HDEL':
+            self._changed(args[0])
+            fields = self.hashes.get(args[0], {})
+            return _integer(sum(fields.pop(field, None) is not None for field in args[1:]))
+        if command == 'HGETALL':
+            items = [v for pair in self.hashes.get(args[0], {}).items() for v in pair]
+            return f"*{len(items)}\r\n".encode() + b''.join(_bulk(v) for v in items)
+        if command == 'HLEN':
+            return _integer(len(self.hashes.get(args[0], {})))
+        return f"-ERR unknown command '{command}'\r\n".encode()
+
+    def _changed(self, name):
+        self.changes[name] = self.changes.get(name, 0) + 1
+
+
+def _integer(value):
+    return f":{value}\r\n".encode()
+
+
+def _bulk(value):
+    if value is None:
+        return b'$-1\r\n'
+    data = value.encode('utf-8')
+    return f"${len(data)}\r\n".encode() + data + b'\r\n'
+
+
+async def serve(host, port):
+    stub = StubRedis()
+    port = await stub.start(host, port)
+    print(f"Stub Redis listening on redis://{host}:{port}/0")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6399)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
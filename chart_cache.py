@@ -0,0 +1,95 @@
+import hashlib
+import json
+import logging
+import time
+
+from sqlite_store import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+
+class ChartCache(SQLiteStore):
+    """On-disk store of finished charts (report text and PNG) keyed by birth data.
+
+    Entries live in a SQLite file and are evicted least-recently-used first
+    once the stored bytes exceed ``max_bytes``.
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS charts (
+        key TEXT PRIMARY KEY, chart TEXT NOT NULL, png BLOB NOT NULL,
+        size INTEGER NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS charts_last_access ON charts(last_access);
+    """
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024):
+        super().__init__(path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(name, year, month, day, hour, minute, location, country_code, scale=4.0, theme="dark",
+                 image_format='png'):
+        """Hash of the normalized inputs of a chart."""
+        normalized = [
+            name.strip(),
+            int(year), int(month), int(day), int(hour), int(minute),
+            location.strip().lower(),
+            country_code.strip().upper(),
+            float(scale),
+            theme,
+        ]
+        if image_format != 'png':
+            normalized.append(image_format)  # Keeps the keys of existing png entries
+        return hashlib.sha256(json.dumps(normalized).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Return ``(chart, png)`` for a cached chart, or None."""
+        with self._lock:
+            conn = self._get_conn()
+            row = conn.execute("SELECT chart, png FROM charts WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            conn.execute("UPDATE charts SET last_access = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+        return row[0], bytes(row[1])
+
+    def put(self, key, chart, png):
+        size = len(chart.encode('utf-8')) + len(png)
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute(
+                "INSERT OR REPLACE INTO charts (key, chart, png, size, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, chart, png, size, now, now),
+            )
+            self._evict()
+            conn.commit()
+
+    def _evict(self):
+        conn = self._get_conn()
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM charts").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = 0
+        for key, size in conn.execute("SELECT key, size FROM charts ORDER BY last_access").fetchall():
+            if total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM charts WHERE key = ?", (key,))
+            total -= size
+            evicted += 1
+        logger.info(f"Chart cache evicted {evicted} entries, {total} bytes remain")
+
+    def stats(self):
+        with self._lock:
+            conn = self._get_conn()
+            entries, total = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM charts").fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': total}
@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger(__name__)
+
+
+class ChartQueueFull(Exception):
+    """Raised when the chart pool already has as many jobs as it can queue."""
+
+
+class ChartPool:
+    """Process pool for the CPU-heavy chart stages (Swiss Ephemeris, SVG, PNG).
+
+    At most ``max_workers`` jobs run at once and ``max_queue`` more may wait
+    for a free worker. Beyond that :meth:`run` raises :class:`ChartQueueFull`
+    right away so the caller can tell the user to come back later instead of
+    piling up work. Jobs waiting for a worker wait here rather than in the
+    executor, so ``timeout`` only counts the time a job really runs. A job
+    that takes longer (e.g. a hung online GeoNames lookup) restarts the pool
+    so it can not keep a worker busy for good; the other jobs that were
+    running in it are submitted again to the new pool. Every new worker runs
+    ``initializer(*initargs)`` first, if given.
+    """
+
+    def __init__(self, max_workers=None, max_queue=32, timeout=60.0, initializer=None, initargs=()):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.initializer = initializer
+        self.initargs = initargs
+        self._executor = None
+        self._pending = 0
+        self._slots = asyncio.Semaphore(self.max_workers)  # One per worker
+        self._recycled = weakref.WeakSet()  # Executors killed on purpose after a timeout
+
+    @property
+    def queue_depth(self):
+        """Jobs submitted to the pool that are waiting for a free worker."""
+        return max(0, self._pending - self.max_workers)
+
+    @property
+    def in_flight(self):
+        return self._pending
+
+    def _get_executor(self):
+        if self._executor is None:
+            # Spawned workers start from a clean interpreter instead of a fork
+            # of the running event loop
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=self.initializer,
+                initargs=self.initargs,
+            )
+        return self._executor
+
+    def _recycle(self, executor):
+        # A job that already started can not be cancelled, so kill the workers
+        # (freeing the stuck one) and let the next job start a new pool. The
+        # other jobs of the old pool fail with BrokenProcessPool
+        if self._executor is executor:
+            self._executor = None
+        self._recycled.add(executor)
+        for process in list((executor._processes or {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False)
+
+    async def run(self, fn, *args):
+        """Run ``fn(*args)`` in a worker process and return its result."""
+        if self._pending >= self.max_workers + self.max_queue:
+            raise ChartQueueFull(f"{self._pending} chart jobs already pending")
+        self._pending += 1
+        try:
+            async with self._slots:
+                return await self._run_now(fn, *args)
+        finally:
+            self._pending -= 1
+
+    async def _run_now(self, fn, *args):
+        # Holding a slot, so a worker is free and the job starts right away
+        name = getattr(fn, '__name__', fn)
+        while True:
+            executor = self._get_executor()
+            try:
+                future = executor.submit(fn, *args)
+            except BrokenProcessPool:
+                logger.error("Chart worker pool is broken, starting a new one")
+                if self._executor is executor:
+                    self._executor = None
+                continue
+            try:
+                return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+            except asyncio.TimeoutError:
+                logger.error(f"Chart job {name} timed out after {self.timeout}s, restarting the chart worker pool")
+                self._recycle(executor)
+                raise
+            except BrokenProcessPool:
+                if executor in self._recycled:
+                    # Killed along with a job that timed out, this one was fine
+                    logger.warning(f"Chart job {name} lost its worker to a pool restart, running it again")
+                    continue
+                # A worker died (e.g. out of memory), the next job gets a fresh pool
+                logger.error("Chart worker died, the pool will be restarted")
+                if self._executor is executor:
+                    self._executor = None
+                raise
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,138 @@
+import importlib.util
+import logging
+import time
+from collections import namedtuple
+from io import BytesIO
+
+from themes import get_theme
+
+# Chart computation and rendering. Everything here is CPU-bound and runs inside
+# the chart worker pool, so it must stay importable without the Telegram bot.
+# kerykeion (with the Swiss Ephemeris), cairosvg and Pillow are imported on
+# first use: the bot process only needs the profiles, the workers load them
+# in their first job or in warm_up().
+logger = logging.getLogger(__name__)
+
+# How a chart image is produced and sent: ``png`` as rendered, ``png8`` quantized
+# to 256 colours (the chart uses a handful) or lossy ``webp``. Both need Pillow
+RenderProfile = namedtuple('RenderProfile', ['name', 'scale', 'image_format'])
+IMAGE_FORMATS = ('png', 'png8', 'webp')
+WEBP_QUALITY = 90
+
+def make_profile(name, scale, image_format='png'):
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"Unknown image format {image_format!r}, expected one of {IMAGE_FORMATS}")
+    if image_format != 'png' and importlib.util.find_spec('PIL') is None:
+        logger.warning(f"Pillow is not installed, the {name} chart profile falls back to png")
+        image_format = 'png'
+    return RenderProfile(name, float(scale), image_format)
+
+def image_extension(image_format):
+    # png8 is still a PNG file
+    return 'webp' if image_format == 'webp' else 'png'
+
+def replace_css_variables(svg_content, theme="dark"):
+    return get_theme(theme).apply(svg_content)
+
+def create_astrological_chart(name, year, month, day, hour, minute, location, country_code, coordinates=None):
+    from kerykeion import Report, AstrologicalSubject, KerykeionChartSVG
+    try:
+        logger.info(f"Creating astrological chart for {name}, {year}-{month}-{day}, {hour}:{minute}, {location}, {country_code}")
+        # With (lng, lat, tz_str) from the gazetteer no GeoNames request is needed
+        offline = {}
+        if coordinates:
+            lng, lat, tz_str = coordinates
+            offline = {'lng': lng, 'lat': lat, 'tz_str': tz_str, 'online': False}
+        subject = AstrologicalSubject(
+            name,
+            int(year),
+            int(month),
+            int(day),
+            int(hour),
+            int(minute),
+            location,
+            country_code,
+            **offline
+        )
+        report = Report(subject)
+        full_report = report.get_full_report()
+        
+        # Create SVG chart in memory, nothing is written to disk
+        natal_chart = KerykeionChartSVG(subject, theme="dark", chart_language="ES")
+        svg_content = natal_chart.makeTemplate()
+        
+        return format_chart(full_report), svg_content
+    except Exception as e:
+        logger.error(f"Error creating astrological chart: {e}")
+        return None, None
+
+def format_chart(chart):
+    if not chart:
+        return "Error generating astrological chart."
+    
+    part_of_interest = chart.split("Date")[1]
+    lines = part_of_interest.split('\n')
+    formatted_lines = []
+    for line in lines:
+        line = line.replace('+', '-')
+        if '-' in line:
+            line = line[:57]
+        formatted_lines.append(line)
+    return "🌟----------------------------------------🌟\nDate" + '\n'.join(formatted_lines)
+
+def encode_image(png, image_format='png'):
+    if image_format == 'png':
+        return png
+    from PIL import Image
+    with Image.open(BytesIO(png)) as image:
+        output = BytesIO()
+        if image_format == 'webp':
+            image.save(output, 'WEBP', quality=WEBP_QUALITY, method=4)
+        else:
+            image.quantize(256, method=Image.Quantize.FASTOCTREE).save(output, 'PNG', optimize=True)
+    return output.getvalue()
+
+def rasterize_chart_profiles(svg_content, profiles, theme="dark"):
+    # Apply the theme colours and parse the SVG once, then render and encode
+    # one image per (scale, image_format). Returns the images and the seconds
+    # spent on each
+    from cairosvg.parser import Tree
+    from cairosvg.surface import PNGSurface
+    svg_content = replace_css_variables(svg_content, theme)
+    tree = Tree(bytestring=svg_content.encode('utf-8'))
+    images, seconds = [], []
+    for scale, image_format in profiles:
+        started = time.perf_counter()
+        output = BytesIO()
+        PNGSurface(tree, output, 96, scale=scale).finish()
+        images.append(encode_image(output.getvalue(), image_format))
+        seconds.append(time.perf_counter() - started)
+    return images, seconds
+
+def render_chart_profiles(name, year, month, day, hour, minute, location, country_code, profiles, theme="dark", coordinates=None):
+    # Full chart job for the worker pool: report text plus one image per
+    # (scale, image_format) in ``profiles``, and the seconds spent in each
+    # stage so the parent process can record them. The images are None if
+    # only the rasterization failed.
+    started = time.perf_counter()
+    chart, svg_content = create_astrological_chart(name, year, month, day, hour, minute, location, country_code, coordinates)
+    computed = time.perf_counter()
+    if not chart:
+        return None, None, {'compute': computed - started}
+    try:
+        images, seconds = rasterize_chart_profiles(svg_content, profiles, theme)
+    except Exception as e:
+        logger.error(f"Error converting chart to an image: {e}")
+        return chart, None, {'compute': computed - started, 'render': [time.perf_counter() - computed]}
+    return chart, images, {'compute': computed - started, 'render': seconds}
+
+def warm_up(profiles, theme="dark"):
+    # Dummy chart job run in each worker at startup: imports kerykeion, reads
+    # the Swiss Ephemeris files and initializes cairo and its fonts, so the
+    # first real chart does not pay for it. Returns the seconds it took
+    started = time.perf_counter()
+    chart, images, _ = render_chart_profiles(
+        "Warm-up", 2000, 1, 1, 12, 0, "Madrid", "ES", profiles, theme, (-3.70256, 40.4165, "Europe/Madrid"))
+    if not chart or images is None:
+        raise RuntimeError("warm-up chart failed")
+    return time.perf_counter() - started
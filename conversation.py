@@ -0,0 +1,499 @@
+"""Channel-agnostic birth data conversation and reading pipeline.
+
+The conversation is a compact state machine: each state has a handler that
+takes the chat and the text of a message, answers through the chat's
+:class:`Channel` and returns the next state. Telegram, WhatsApp or a fake
+test channel only turn their messages into :meth:`ConversationEngine.handle`
+calls and implement :class:`Channel`, so every front end shares the engine's
+chart pool, caches, scheduler and session store.
+"""
+import asyncio
+import logging
+import math
+import time
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+
+from chart_pool import ChartQueueFull
+from charts import image_extension
+from gazetteer import normalize_string
+from observability import CHART_BYTES_SENT, instrument_handler, stage
+from scheduler import SchedulerFull
+
+logger = logging.getLogger(__name__)
+
+# Conversation states, stored in each chat's session. END means no conversation is running
+(NAME, YEAR, MONTH, DAY, TIME, LOCATION, COUNTRY_CODE, REPEAT) = range(8)
+END = None
+
+# Birth data a chart is drawn from, kept as "last_chart" for /hd
+CHART_FIELDS = ("name", "year", "month", "day", "hour", "minute", "location", "country_code", "coordinates")
+
+GOODBYE = "✨ Lamentablemente, nuestros caminos se separan. ¡Espero que nuestros caminos se crucen de nuevo!"
+RETRY_LOCATION = "🌠 Las estrellas están muy solicitadas ahora mismo. Escríbeme de nuevo tu ciudad en un momento y lo vuelvo a intentar."
+
+
+def strip_leading_zeros(number_str):
+    try:
+        return str(int(number_str))
+    except ValueError:
+        return None
+
+
+def validate_time(time_str):
+    try:
+        hour, minute = map(int, time_str.split(":"))
+        if 0 <= hour <= 23 and 0 <= minute <= 59:
+            return hour, minute
+        else:
+            return None, None
+    except ValueError:
+        return None, None
+
+
+def retry_minutes(seconds):
+    return max(1, math.ceil(seconds / 60))
+
+
+class MessagePacer:
+    """Keeps at least `interval` seconds between consecutive bot messages."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._last = None
+
+    async def wait(self):
+        loop = asyncio.get_running_loop()
+        if self._last is not None:
+            delay = self._last + self.interval - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        self._last = loop.time()
+
+
+class Channel:
+    """A messaging front end the engine answers through."""
+
+    name = None
+
+    async def send_text(self, chat_id, text):
+        raise NotImplementedError
+
+    async def send_image(self, chat_id, image, filename, caption=None, full_resolution=False):
+        """Send ``image`` bytes; ``full_resolution`` asks to keep them uncompressed if the channel can."""
+        raise NotImplementedError
+
+
+class Chat:
+    """The chat a message came from: where to answer and its session."""
+
+    def __init__(self, channel, chat_id, user_id, session):
+        self.channel = channel
+        self.chat_id = chat_id
+        self.user_id = chat_id if user_id is None else user_id
+        self.session = session
+        self.reading_due = False  # Start a reading once the session is saved
+
+    @property
+    def key(self):
+        return self.channel.name, str(self.chat_id)
+
+    @property
+    def user_key(self):
+        # User ids of different channels may collide
+        return f"{self.channel.name}:{self.user_id}"
+
+    @property
+    def data(self):
+        return self.session["data"]
+
+    async def send(self, text):
+        await self.channel.send_text(self.chat_id, text)
+
+
+class ConversationEngine:
+    """Runs the birth data conversation of every chat, whatever its channel.
+
+    Messages of a chat are handled one at a time and in order. A reading
+    (chart and prediction) runs in the background once the place is known,
+    and so does the full resolution chart asked with /hd, so they can wait in
+    ``scheduler`` without holding up the front end; while one runs every
+    message of the chat gets a "still waiting" answer.
+
+    ``get_chart_images(birth_data, profiles)`` returns ``(chart, {profile
+    name: image})``, ``stream_prediction(name, location, chart)`` yields the
+    prediction paragraphs, ``resolve_place(location, country_code=None)``
+    returns a gazetteer place or None (it may block on a fuzzy search, so it
+    runs in a thread) and ``log_interaction(channel, user_id, chat_id,
+    birth_data)`` records a finished reading, ``channel`` being the channel's
+    name. ``on_handled()`` is called after each handled message.
+
+    When several processes share ``sessions``, a reading takes a lease in
+    the chat's session for at most ``reading_lease`` seconds, so the other
+    processes answer "still waiting" instead of starting it again.
+    """
+
+    def __init__(self, sessions, scheduler, get_chart_images, stream_prediction, resolve_place, preview, hd,
+                 hd_eager=False, log_interaction=None, message_min_interval=2.0, priority_users=(),
+                 on_handled=None, reading_lease=900.0):
+        self.sessions = sessions
+        self.scheduler = scheduler
+        self.get_chart_images = get_chart_images
+        self.stream_prediction = stream_prediction
+        self.resolve_place = resolve_place
+        self.preview = preview
+        self.hd = hd
+        self.hd_eager = hd_eager
+        self.log_interaction = log_interaction
+        self.message_min_interval = message_min_interval
+        self.priority_users = {str(user) for user in priority_users}
+        self.on_handled = on_handled
+        self.reading_lease = reading_lease
+        self._chats = {}  # chat key -> [lock, messages waiting for it]
+        self._readings = {}  # chat key -> reading task
+        # Latency, errors and in-flight conversations for each handler, see observability.py
+        self._start = instrument_handler('start', self._start, end_state=END)
+        self._cancel = instrument_handler('cancel', self._cancel, end_state=END)
+        self._states = {
+            NAME: instrument_handler('name', self._name, end_state=END),
+            YEAR: instrument_handler('year', self._year, end_state=END),
+            MONTH: instrument_handler('month', self._month, end_state=END),
+            DAY: instrument_handler('day', self._day, end_state=END),
+            TIME: instrument_handler('time', self._time, end_state=END),
+            LOCATION: instrument_handler('location', self._location, end_state=END),
+            COUNTRY_CODE: instrument_handler('country_code', self._country_code, end_state=END),
+            REPEAT: instrument_handler('repeat', self._repeat, end_state=END),
+        }
+
+    @asynccontextmanager
+    async def _locked(self, key):
+        entry = self._chats.get(key)
+        if entry is None:
+            entry = self._chats[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chats[key]
+
+    async def handle(self, channel, chat_id, user_id, text):
+        """Answer one text message of ``chat_id`` on ``channel``."""
+        text = (text or "").strip()
+        if not text:
+            return
+        # "/start@bot_name" in Telegram groups
+        command = text.split()[0].split("@")[0].lower() if text.startswith("/") else None
+        chat = Chat(channel, chat_id, user_id, None)
+        async with self._locked(chat.key):
+            if chat.key in self._readings:
+                await self._still_waiting(chat)
+            else:
+                chat.session = await self.sessions.load(*chat.key)
+                if chat.session.get("reading_until", 0) > time.time():
+                    # The reading runs in another process
+                    await self._still_waiting(chat)
+                else:
+                    await self._dispatch(chat, command, text)
+        if self.on_handled is not None:
+            self.on_handled()
+
+    async def _dispatch(self, chat, command, text):
+        state = chat.session["state"]
+        if command == "/start" or (command is None and state is END):
+            state = await self._start(chat, text)
+        elif command == "/hd":
+            await self._send_hd(chat)
+        elif command == "/cancel" and state is not END:
+            state = await self._cancel(chat, text)
+        elif command is None:
+            state = await self._states[state](chat, text)
+        # Other commands are ignored
+        if await self._save(chat, state) and chat.reading_due:
+            self._start_reading(chat)
+
+    async def close(self):
+        """Cancel the readings and /hd charts in progress, reading chats stay at LOCATION."""
+        tasks = list(self._readings.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _start(self, chat, text):
+        chat.data.pop("readings", None)
+        await chat.send("✨🌙 ¡Hola, ser cósmico! Soy la A.I.stróloga, y estoy aquí para decirte cosas que ya sabías, pero con estrellas y planetas de fondo. 😜 ¿Cuál es tu nombre?")
+        return NAME
+
+    async def _name(self, chat, text):
+        if len(text) > 40:
+            await chat.send("😅 Bueno, parece que tu nombre es más largo que una explicación de los retrógrados de Mercurio. ¿Puedes darme uno más corto, porfa?")
+            return NAME
+        chat.data["name"] = text
+        await chat.send(f"🌟 Encantada, {text}. Ahora dime, ¿en qué año naciste y te uniste a este hermoso caos cósmico? (Por favor, no me digas que eres de los 2000, ¡me haces sentir vieja!)")
+        return YEAR
+
+    async def _year(self, chat, text):
+        year = strip_leading_zeros(text)
+        if year is not None and 1900 <= int(year) <= 2027:
+            chat.data["year"] = year
+            await chat.send("📅 ¡Qué interesante! Ahora dime, ¿en qué mes naciste? Pero por favor, no me digas que eres un Cáncer... ¡ya tenemos suficientes emociones por hoy! 😅 [Dame el número del mes del 1 al 12]")
+            return MONTH
+        await chat.send("⏳ Ese año no me suena a uno real, al menos no en esta dimensión. Intenta con otro. Formato AAAA (Ejemplo: 1984)")
+        return YEAR
+
+    async def _month(self, chat, text):
+        month = strip_leading_zeros(text)
+        if month is not None and 1 <= int(month) <= 12:
+            chat.data["month"] = month
+            await chat.send("🌒 ¡Qué bien! Ahora, ¿en qué día decidiste bendecirnos con tu presencia? 😏")
+            return DAY
+        await chat.send("📆 Ese mes no parece válido en mi carta astral. Prueba con otro.")
+        return MONTH
+
+    async def _day(self, chat, text):
+        day = strip_leading_zeros(text)
+        if day is not None and 1 <= int(day) <= 31:
+            chat.data["day"] = day
+            await chat.send("⏰ ¡Qué intrigante! Y, ¿a qué hora comenzó todo? (Por favor, usa el formato HH:MM, en formato 24h, y espero que no sea la hora de las brujas o algo así). [Ejemplo: 18:35]")
+            return TIME
+        await chat.send("🗓️ ¡Uy! Ese día no es válido en mi calendario cósmico. Prueba con otro.")
+        return DAY
+
+    async def _time(self, chat, text):
+        hour, minute = validate_time(text)
+        if hour is not None:
+            chat.data["hour"] = hour
+            chat.data["minute"] = minute
+            await chat.send("🌍 Fascinante, ahora dime el lugar de tu aterrizaje en este planeta. (Introduce la ciudad grande más cercana donde naciste!)")
+            return LOCATION
+        await chat.send("⌛ Lo siento, pero ese formato de hora no lo aceptamos en esta parte del universo. Prueba con el formato HH:MM.")
+        return TIME
+
+    def _set_place(self, chat, place):
+        if place:
+            chat.data["country_code"] = place.country_code
+            chat.data["coordinates"] = (place.lng, place.lat, place.tz_str)
+        else:
+            chat.data.pop("coordinates", None)
+
+    async def _location(self, chat, text):
+        location = normalize_string(text)
+        if len(location) > 50:
+            await chat.send("🌆 Ese lugar parece un poco largo para mi mapa estelar. ¿Puedes darme una ciudad más principal?")
+            return LOCATION
+        chat.data["location"] = location
+        logger.info(f"Location received: {location}")
+        place = await asyncio.to_thread(self.resolve_place, location)
+        self._set_place(chat, place)
+        if not place:
+            await chat.send("🌍 Mmm, no encuentro tu ciudad en mis estrellas. ¿Puedes indicarme el código de país (por ejemplo, ES para España, AR para Argentina)?")
+            return COUNTRY_CODE
+        return self._begin_reading(chat)
+
+    async def _country_code(self, chat, text):
+        country_code = text.upper()
+        if len(country_code) != 2:
+            await chat.send("🌍 Ese código de país no parece válido. Por favor, introduce las dos letras que indican tu país (por ejemplo, ES para España, AR para Argentina).")
+            return COUNTRY_CODE
+        chat.data["country_code"] = country_code
+        # Without a local match kerykeion falls back to an online GeoNames lookup
+        self._set_place(chat, await asyncio.to_thread(self.resolve_place, chat.data["location"], country_code))
+        return self._begin_reading(chat)
+
+    async def _repeat(self, chat, text):
+        if text.lower().startswith('s'):
+            await chat.send("🌠 ¡Maravilloso! ¿Cuál es el nombre de esta nueva alma?")
+            return NAME
+        await chat.send(GOODBYE)
+        return END
+
+    async def _cancel(self, chat, text):
+        await chat.send(GOODBYE)
+        return END
+
+    def _reading_tier(self, chat):
+        if str(chat.user_id) in self.priority_users:
+            return 0
+        # Repeats from the REPEAT state wait behind first readings
+        return 2 if chat.data.get("readings") else 1
+
+    def _begin_reading(self, chat):
+        # The chat stays at LOCATION until the reading is over, so after a
+        # restart the user only has to send the city again
+        if self.sessions.shared:
+            # Expires on its own if this process dies before the reading ends
+            chat.session["reading_until"] = time.time() + self.reading_lease
+        chat.reading_due = True
+        return LOCATION
+
+    def _start_reading(self, chat):
+        self._run_in_background(chat, self._reading(chat))
+
+    def _run_in_background(self, chat, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._readings[chat.key] = task
+        # Only needed when the task is cancelled, it removes itself when done
+        task.add_done_callback(lambda done: self._forget_reading(chat.key, done))
+
+    def _forget_reading(self, key, task):
+        # A newer reading of the chat may have replaced this one already
+        if self._readings.get(key) is task:
+            del self._readings[key]
+
+    async def _reading(self, chat):
+        async def notify_queued(position):
+            await chat.send(f"⏳ Hay mucha gente consultando las estrellas. Estás en la cola, posición {position}. Te escribo en cuanto sea tu turno.")
+
+        try:
+            try:
+                async with self.scheduler.slot(chat.user_key, self._reading_tier(chat), on_queued=notify_queued):
+                    state = await self._chart_and_prediction(chat)
+            except SchedulerFull as e:
+                logger.warning(f"Reading refused for user {chat.user_key}: {e}")
+                if e.retry_after:
+                    await chat.send(f"⏳ Las estrellas necesitan descansar después de tantas consultas. Escríbeme de nuevo tu ciudad en {retry_minutes(e.retry_after)} minutos.")
+                else:
+                    await chat.send("🌠 Las estrellas aún están trabajando en tu consulta anterior o hay demasiada gente esperando. Escríbeme de nuevo tu ciudad en un momento.")
+                state = LOCATION
+            except asyncio.TimeoutError:
+                logger.warning(f"Reading for user {chat.user_key} waited more than {self.scheduler.max_wait}s in the queue")
+                await chat.send(RETRY_LOCATION)
+                state = LOCATION
+        except asyncio.CancelledError:
+            if "reading_until" in chat.session:
+                # Let another process take the chat right away
+                chat.session.pop("reading_until")
+                await self._save(chat, LOCATION)
+            raise
+        except Exception as e:
+            logger.error(f"Error answering chat {chat.key}: {e}")
+            state = LOCATION
+        async with self._locked(chat.key):
+            self._forget_reading(chat.key, asyncio.current_task())
+            chat.session.pop("reading_until", None)
+            await self._save(chat, state)
+
+    async def _save(self, chat, state):
+        """Save the chat's session, False if another process changed it meanwhile."""
+        chat.session["state"] = state
+        if not self.sessions.shared:
+            self.sessions.save(*chat.key, chat.session)
+            return True
+        # The next message may go to another process
+        return await self.sessions.commit(*chat.key, chat.session)
+
+    async def _still_waiting(self, chat):
+        position = self.scheduler.position(chat.user_key)
+        if position:
+            await chat.send(f"⏳ Sigues en la cola, posición {position}. ¡Ya casi es tu turno!")
+        else:
+            await chat.send("🔮 Sigo consultando las estrellas para ti, dame un momento...")
+
+    async def _send_chart(self, chat, profile, image, caption=None):
+        filename = f"carta_astral.{image_extension(profile.image_format)}"
+        with stage("send_chart", profile=profile.name, bytes=len(image), channel=chat.channel.name):
+            # Anything but the preview is meant to keep its full resolution
+            await chat.channel.send_image(chat.chat_id, image, filename, caption=caption,
+                                          full_resolution=profile != self.preview)
+        CHART_BYTES_SENT.inc(len(image), profile=profile.name)
+        logger.info(f"Sent {profile.name} chart: {len(image)} bytes")
+
+    async def _send_hd(self, chat):
+        last_chart = chat.data.get("last_chart")
+        if not last_chart:
+            await chat.send("🔭 Todavía no he dibujado ninguna carta para ti. Escribe /start y empezamos.")
+            return
+        # May wait in the scheduler for minutes, the chat's other messages are
+        # answered meanwhile like during a reading
+        self._run_in_background(chat, self._hd(chat, dict(last_chart)))
+
+    async def _hd(self, chat, last_chart):
+        async def notify_queued(position):
+            await chat.send(f"⏳ Hay mucha gente consultando las estrellas. Estás en la cola, posición {position}.")
+
+        try:
+            # Rendering at full resolution is as expensive as a chart, it takes
+            # the user's turn and tokens like a reading does
+            async with self.scheduler.slot(chat.user_key, self._reading_tier(chat), on_queued=notify_queued):
+                chart, images = await self.get_chart_images(last_chart, [self.hd])
+        except (SchedulerFull, ChartQueueFull, BrokenProcessPool, asyncio.TimeoutError) as e:
+            logger.warning(f"HD chart refused for user {chat.user_key}: {e!r}")
+            if getattr(e, 'retry_after', None):
+                await chat.send(f"⏳ Las estrellas necesitan descansar después de tantas consultas. Vuelve a pedirme /hd en {retry_minutes(e.retry_after)} minutos.")
+            else:
+                await chat.send("🌠 Las estrellas están muy solicitadas ahora mismo. Vuelve a pedirme /hd en un momento.")
+            return
+        except Exception as e:
+            logger.error(f"Error rendering the HD chart of {chat.key}: {e}")
+            await chat.send("⚠️ Hubo un problema al preparar tu carta astral en alta resolución.")
+            return
+        image = images.get(self.hd.name)
+        if image is None:
+            await chat.send("⚠️ Hubo un problema al preparar tu carta astral en alta resolución.")
+            return
+        try:
+            await self._send_chart(chat, self.hd, image)
+        except Exception as e:
+            logger.error(f"Error sending chart image: {e}")
+            await chat.send("⚠️ Hubo un problema al enviar tu carta astral en alta resolución.")
+
+    async def _chart_and_prediction(self, chat):
+        data = chat.data
+        try:
+            try:
+                profiles = [self.preview, self.hd] if self.hd_eager else [self.preview]
+                chart, images = await self.get_chart_images(data, profiles)
+            except (ChartQueueFull, BrokenProcessPool, asyncio.TimeoutError) as e:
+                logger.warning(f"Chart pool unavailable: {e!r}")
+                await chat.send(RETRY_LOCATION)
+                return LOCATION
+            if chart:
+                pacer = MessagePacer(self.message_min_interval)
+                data["last_chart"] = {field: data.get(field) for field in CHART_FIELDS}
+                await chat.send("🌌 Un momento que me concentre...")
+                await chat.send(f"🌌 ¡Aquí está tu carta astral, revelada a mis ojos!\n\n\n{chart}")
+
+                # Send the preview straight from memory, the full resolution one is sent on /hd
+                sent = False
+                preview = images.get(self.preview.name)
+                if preview is not None:
+                    try:
+                        await self._send_chart(chat, self.preview, preview,
+                                               caption="🔭 Escribe /hd para recibirla en alta resolución.")
+                        sent = True
+                    except Exception as e:
+                        logger.error(f"Error sending chart image: {e}")
+                if not sent:
+                    await chat.send("⚠️ Hubo un problema al convertir o enviar tu carta astral en formato PNG.")
+
+                await chat.send("🔮 Dame un momento mientras consulto las estrellas y tejo tu predicción...")
+                await pacer.wait()
+
+                # Forward each paragraph as soon as the model finishes it
+                first = True
+                async for paragraph in self.stream_prediction(data["name"], data["location"], chart):
+                    if first:
+                        await chat.send("⭐ Con las estrellas como testigo, aquí está tu predicción:")
+                        first = False
+                    await pacer.wait()
+                    await chat.send(paragraph)
+
+                if self.log_interaction is not None:
+                    self.log_interaction(chat.channel.name, chat.user_id, chat.chat_id, data)
+                data["readings"] = data.get("readings", 0) + 1
+                await pacer.wait()
+                await chat.send('🌟 ¡Espero que mis palabras resuenen contigo! ¿Te gustaría seguir preguntando sobre otras almas que deseas conocer más?')
+                return REPEAT
+            else:
+                error_message = f"Error generating chart for: {data}"
+                print(error_message)  # Debug print
+                await chat.send(f"⚠️ Hubo un error al generar tu carta astral. Detalles: {error_message}")
+                return END
+        except Exception as e:
+            error_message = f"Exception occurred: {str(e)}\nUser data: {data}"
+            print(error_message)  # Debug print
+            logger.error(error_message)
+            await chat.send(f"⚠️ Hubo un error al generar tu carta astral. Detalles: {error_message}")
+            return END
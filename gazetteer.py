@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+import argparse
+import bisect
+import difflib
+import logging
+import mmap
+import os
+import struct
+import unicodedata
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+# Binary index layout: header, newline separated timezone table, then fixed
+# size records sorted by normalized name (and by population within a name)
+MAGIC = b'GAZ1'
+HEADER = struct.Struct('<4sIII')  # magic, record count, timezone count, timezone table size
+KEY_SIZE = 40
+RECORD = struct.Struct(f'<{KEY_SIZE}s2sddIH')  # key, country code, lat, lng, population, timezone index
+
+
+def normalize_string(input_str):
+    return ''.join(
+        c for c in unicodedata.normalize('NFD', input_str)
+        if unicodedata.category(c) != 'Mn'
+    ).lower()
+
+
+def normalize_place(name):
+    # Accent and case insensitive, punctuation and repeated spaces collapsed
+    normalized = ''.join(c if c.isalnum() else ' ' for c in normalize_string(name))
+    return ' '.join(normalized.split())
+
+
+def _encode_key(name):
+    return normalize_place(name).encode('utf-8')[:KEY_SIZE]
+
+
+@dataclass(frozen=True)
+class Place:
+    name: str
+    country_code: str
+    lat: float
+    lng: float
+    tz_str: str
+    population: int
+
+
+def read_bundled(path):
+    # data/cities.tsv: name, country, lat, lng, timezone, population, alternate names
+    with open(path, encoding='utf-8') as source:
+        for line in source:
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            names = [fields[0]] + [n for n in fields[6].split(',') if n] if len(fields) > 6 else [fields[0]]
+            yield names, fields[1], float(fields[2]), float(fields[3]), fields[4], int(fields[5] or 0)
+
+
+def read_geonames(path):
+    # GeoNames cities dumps (cities500.txt, cities15000.txt, ...), see
+    # https://download.geonames.org/export/dump/readme.txt
+    with open(path, encoding='utf-8') as source:
+        for line in source:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 18:
+                continue
+            # Only keep alternate names written in Latin script, skipping codes like "BUE"
+            alternates = [n for n in fields[3].split(',')
+                          if n and not n.isupper() and normalize_place(n).isascii()]
+            yield ([fields[1], fields[2]] + alternates, fields[8], float(fields[4]), float(fields[5]),
+                   fields[17], int(fields[14] or 0))
+
+
+def _read_source(path):
+    with open(path, encoding='utf-8') as source:
+        first = next((line for line in source if line.strip() and not line.startswith('#')), '')
+    if len(first.split('\t')) >= 18:
+        return read_geonames(path)
+    return read_bundled(path)
+
+
+def build_index(sources, index_path):
+    """Build the binary index from the bundled TSV and/or GeoNames dumps."""
+    timezones = {}
+    records = {}
+    for path in sources:
+        for names, country_code, lat, lng, tz_str, population in _read_source(path):
+            tz_index = timezones.setdefault(tz_str, len(timezones))
+            for name in names:
+                key = _encode_key(name)
+                if not key:
+                    continue
+                # The same place listed twice (e.g. name and ascii name) is stored once
+                dedupe = (key, country_code, round(lat, 2), round(lng, 2))
+                if dedupe not in records or records[dedupe][4] < population:
+                    records[dedupe] = (key, country_code.encode('ascii')[:2], lat, lng, population, tz_index)
+    rows = sorted(records.values(), key=lambda r: (r[0], -r[4]))
+    tz_table = '\n'.join(timezones).encode('utf-8')
+    directory = os.path.dirname(index_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{index_path}.tmp"
+    with open(tmp_path, 'wb') as index_file:
+        index_file.write(HEADER.pack(MAGIC, len(rows), len(timezones), len(tz_table)))
+        index_file.write(tz_table)
+        for row in rows:
+            index_file.write(RECORD.pack(*row))
+    os.replace(tmp_path, index_path)
+    logger.info(f"Gazetteer index built with {len(rows)} names in {index_path}")
+    return len(rows)
+
+
+class _Keys:
+    # Sequence view over the record keys so bisect can search the mmap directly
+    def __init__(self, gazetteer):
+        self._gazetteer = gazetteer
+
+    def __len__(self):
+        return self._gazetteer.count
+
+    def __getitem__(self, i):
+        return self._gazetteer._key(i)
+
+
+class Gazetteer:
+    """Offline city lookup over a memory-mapped, sorted index.
+
+    Names are matched accent and case insensitively. :meth:`resolve` tries an
+    exact match, then an unambiguous prefix, then a close fuzzy match. When a
+    name exists in several countries, ``preferred_countries`` win over
+    population.
+    """
+
+    def __init__(self, path, preferred_countries=()):
+        self.path = path
+        self.preferred_countries = [c.upper() for c in preferred_countries]
+        with open(path, 'rb') as index_file:
+            self._mm = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, tz_count, tz_size = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a gazetteer index")
+        tz_start = HEADER.size
+        self._timezones = self._mm[tz_start:tz_start + tz_size].decode('utf-8').split('\n')
+        self._offset = tz_start + tz_size
+        self._keys = _Keys(self)
+
+    def _key(self, i):
+        offset = self._offset + i * RECORD.size
+        return self._mm[offset:offset + KEY_SIZE].rstrip(b'\0')
+
+    def _place(self, i):
+        key, country_code, lat, lng, population, tz_index = RECORD.unpack_from(
+            self._mm, self._offset + i * RECORD.size)
+        return Place(key.rstrip(b'\0').decode('utf-8', 'ignore'), country_code.decode('ascii'),
+                     lat, lng, self._timezones[tz_index], population)
+
+    def _rank(self, place):
+        preferred = (self.preferred_countries.index(place.country_code)
+                     if place.country_code in self.preferred_countries else len(self.preferred_countries))
+        return preferred, -place.population
+
+    def _best(self, places, country_code=None):
+        if country_code:
+            places = [p for p in places if p.country_code == country_code.upper()]
+        return min(places, key=self._rank) if places else None
+
+    def _prefix_range(self, prefix):
+        i = bisect.bisect_left(self._keys, prefix)
+        while i < self.count:
+            key = self._key(i)
+            if not key.startswith(prefix):
+                break
+            yield i, key
+            i += 1
+
+    def lookup(self, name, country_code=None):
+        """Exact (normalized) match, or None."""
+        key = _encode_key(name)
+        if not key:
+            return None
+        places = [self._place(i) for i, k in self._prefix_range(key) if k == key]
+        return self._best(places, country_code)
+
+    def search(self, prefix, country_code=None, limit=5):
+        """Places whose name starts with ``prefix``, most relevant first."""
+        key = _encode_key(prefix)
+        if not key:
+            return []
+        places = [self._place(i) for i, _ in self._prefix_range(key)]
+        if country_code:
+            places = [p for p in places if p.country_code == country_code.upper()]
+        return sorted(places, key=self._rank)[:limit]
+
+    def fuzzy(self, name, country_code=None, cutoff=0.85):
+        """Closest name among those sharing the first two letters, for typos.
+
+        The first letter followed by the third also counts, so a swapped or
+        missing second letter is still found. Only names of a length that
+        could reach ``cutoff`` are compared.
+        """
+        normalized = normalize_place(name)
+        if not normalized:
+            return None
+        prefixes = {normalized[:2]}
+        if len(normalized) > 2:
+            prefixes.add(normalized[0] + normalized[2])
+        # difflib's ratio is 2 * matches / total length, so it caps the length difference
+        size = len(normalized.encode('utf-8'))
+        shortest, longest = size * cutoff / (2 - cutoff), size * (2 - cutoff) / cutoff
+        candidates = {k.decode('utf-8', 'ignore') for prefix in prefixes
+                      for _, k in self._prefix_range(prefix.encode('utf-8')) if shortest <= len(k) <= longest}
+        matches = difflib.get_close_matches(normalized, candidates, n=3, cutoff=cutoff)
+        for match in matches:
+            place = self.lookup(match, country_code)
+            if place:
+                return place
+        return None
+
+    def resolve(self, name, country_code=None):
+        place = self.lookup(name, country_code)
+        if place:
+            return place
+        if len(normalize_place(name)) >= 4:
+            places = self.search(name, country_code, limit=50)
+            if places and len({p.name for p in places}) == 1:
+                return places[0]
+        return self.fuzzy(name, country_code)
+
+    def close(self):
+        self._mm.close()
+
+
+def load_gazetteer(index_path, sources, preferred_countries=()):
+    """Open the index, (re)building it first if a source is newer."""
+    sources = [s for s in sources if s and os.path.exists(s)]
+    if not os.path.exists(index_path) or any(
+            os.path.getmtime(s) > os.path.getmtime(index_path) for s in sources):
+        build_index(sources, index_path)
+    return Gazetteer(index_path, preferred_countries)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the offline gazetteer index")
+    parser.add_argument('sources', nargs='*', default=['data/cities.tsv'],
+                        help="Bundled TSV files and/or GeoNames cities dumps")
+    parser.add_argument('--index', default=os.getenv("GAZETTEER_INDEX_PATH", "cache/gazetteer.idx"))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(f"Indexed {build_index(args.sources, args.index)} names into {args.index}")
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+import argparse
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ('created_at', 'channel', 'user_id', 'chat_id', 'name', 'birth_date', 'birth_time', 'location', 'country_code', 'source')
+INSERT_SQL = f"INSERT INTO interactions ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS interactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL,
+    channel TEXT,
+    user_id INTEGER,
+    chat_id INTEGER,
+    name TEXT,
+    birth_date TEXT,
+    birth_time TEXT,
+    location TEXT,
+    country_code TEXT,
+    source TEXT NOT NULL DEFAULT 'bot'
+);
+"""
+
+# Created after _add_channel(), the table of an older database has no channel column yet
+INDEXES = """
+CREATE INDEX IF NOT EXISTS interactions_user ON interactions(channel, user_id, created_at);
+CREATE INDEX IF NOT EXISTS interactions_created_at ON interactions(created_at);
+CREATE INDEX IF NOT EXISTS interactions_birth_date ON interactions(birth_date);
+"""
+
+
+def connect(path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    _add_channel(conn)
+    conn.executescript(INDEXES)
+    return conn
+
+
+def _add_channel(conn):
+    # User ids are only unique within a channel (Telegram ids, WhatsApp numbers)
+    if any(column[1] == 'channel' for column in conn.execute("PRAGMA table_info(interactions)")):
+        return
+    with conn:
+        conn.execute("ALTER TABLE interactions ADD COLUMN channel TEXT")
+        # WhatsApp chats are the sender's whatsapp:+<number> address
+        conn.execute("UPDATE interactions SET channel = CASE WHEN chat_id LIKE 'whatsapp:%' "
+                     "THEN 'whatsapp' ELSE 'telegram' END WHERE source = 'bot'")
+        conn.execute("DROP INDEX IF EXISTS interactions_user")
+
+
+class InteractionStore:
+    """SQLite (WAL) log of user interactions, written by a background task.
+
+    :meth:`log` only puts the record on a queue, so it never blocks the
+    response path. The writer task drains the queue and commits in batches
+    of up to ``batch_size`` rows, or every ``flush_interval`` seconds.
+    """
+
+    def __init__(self, path, batch_size=100, flush_interval=1.0, max_queue=10000):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = asyncio.Queue(maxsize=max_queue)
+        self._conn = None
+        self._task = None
+
+    async def start(self):
+        self._conn = await asyncio.to_thread(connect, self.path)
+        self._task = asyncio.create_task(self._writer())
+
+    def log(self, channel=None, user_id=None, chat_id=None, name=None, birth_date=None, birth_time=None,
+            location=None, country_code=None):
+        record = (time.time(), channel, user_id, chat_id, name, birth_date, birth_time, location, country_code, 'bot')
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            logger.error(f"Interaction queue full, dropping record for {channel} user {user_id}")
+
+    async def _writer(self):
+        stopping = False
+        while not stopping:
+            batch = [await self._queue.get()]
+            deadline = asyncio.get_running_loop().time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            if None in batch:
+                stopping = True
+                batch = [record for record in batch if record is not None]
+            if batch:
+                try:
+                    await asyncio.to_thread(self._write_batch, batch)
+                except sqlite3.Error as e:
+                    logger.error(f"Error writing {len(batch)} interactions: {e}")
+
+    def _write_batch(self, batch):
+        with self._conn:
+            self._conn.executemany(INSERT_SQL, batch)
+
+    async def close(self):
+        if self._task is not None:
+            # None tells the writer to flush what is left and stop
+            await self._queue.put(None)
+            await self._task
+            self._task = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def parse_users_txt(path):
+    """Yield the records of the legacy users.txt log, one per interaction."""
+    record = {}
+    with open(path, encoding='utf-8', errors='replace') as users_file:
+        for line in users_file:
+            line = line.strip()
+            if line.startswith('---'):
+                if record:
+                    yield record
+                record = {}
+                continue
+            key, _, value = line.partition(': ')
+            record[key.lower()] = value.strip()
+    if record:
+        yield record
+
+
+def _legacy_row(record):
+    birth_date = None
+    day, _, rest = record.get('date', '').partition('-')
+    month, _, year = rest.partition('-')
+    if day.isdigit() and month.isdigit() and year.isdigit():
+        birth_date = f"{int(year):04d}-{int(month):02d}-{int(day):02d}"
+    birth_time = None
+    hour, _, minute = record.get('time', '').partition(':')
+    if hour.isdigit() and minute.isdigit():
+        birth_time = f"{int(hour):02d}:{int(minute):02d}"
+    return (None, None, None, None, record.get('name'), birth_date, birth_time,
+            record.get('location'), None, 'users.txt')
+
+
+def import_users_txt(db_path, users_path):
+    """One-shot import of users.txt. Returns the number of rows imported."""
+    conn = connect(db_path)
+    try:
+        if conn.execute("SELECT 1 FROM interactions WHERE source = 'users.txt' LIMIT 1").fetchone():
+            logger.info(f"{users_path} was already imported into {db_path}")
+            return 0
+        rows = [_legacy_row(record) for record in parse_users_txt(users_path)]
+        with conn:
+            conn.executemany(INSERT_SQL, rows)
+        return len(rows)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import the legacy users.txt log into the interaction store")
+    parser.add_argument('users_file', nargs='?', default='users.txt')
+    parser.add_argument('--db', default=os.getenv("INTERACTIONS_DB_PATH", "interactions.sqlite"))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(f"Imported {import_users_txt(args.db, args.users_file)} interactions into {args.db}")
@@ -0,0 +1,385 @@
+import asyncio
+import contextvars
+import json
+import logging
+import random
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_labels(self.labelnames, key)} {_number(value)}"
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self._function = function
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        """Read the value from ``function()`` at scrape time (unlabelled gauges only)."""
+        self._function = function
+
+    def _samples(self):
+        if self._function is not None:
+            yield f"{self.name} {_number(self._function())}"
+            return
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_labels(self.labelnames, key)} {_number(value)}"
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self._values[key] = (counts, total + value)
+
+    def _samples(self):
+        for key, (counts, total) in sorted(self._values.items()):
+            for bound, count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket{_labels(self.labelnames, key, [('le', _number(bound))])} {count}"
+            yield f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}"
+            yield f"{self.name}_count{_labels(self.labelnames, key)} {counts[-1]}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self._metrics.values()) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram('astrobot_stage_seconds', "Latency of each pipeline stage", ['stage'])
+HANDLER_SECONDS = REGISTRY.histogram('astrobot_handler_seconds', "Latency of each conversation handler", ['state'])
+CONVERSATIONS_IN_FLIGHT = REGISTRY.gauge('astrobot_conversations_in_flight', "Conversations that have not ended yet")
+CHART_QUEUE_DEPTH = REGISTRY.gauge('astrobot_chart_queue_depth', "Chart jobs waiting for a free worker")
+CHART_JOBS_IN_FLIGHT = REGISTRY.gauge('astrobot_chart_jobs_in_flight', "Chart jobs running or queued")
+ERRORS = REGISTRY.counter('astrobot_errors_total', "Errors by stage", ['stage'])
+CACHE_HITS = REGISTRY.counter('astrobot_cache_hits_total', "Cache hits", ['cache'])
+CACHE_MISSES = REGISTRY.counter('astrobot_cache_misses_total', "Cache misses", ['cache'])
+OPENAI_TOKENS = REGISTRY.counter('astrobot_openai_tokens_total', "Tokens used by OpenAI calls", ['kind'])
+CHART_BYTES_SENT = REGISTRY.counter('astrobot_chart_bytes_sent_total', "Bytes of chart images sent", ['profile'])
+WEBHOOK_UPDATES = REGISTRY.counter('astrobot_webhook_updates_total', "Updates received by the webhook", ['status'])
+WHATSAPP_MESSAGES = REGISTRY.counter('astrobot_whatsapp_messages_total', "Messages received by the WhatsApp webhook", ['status'])
+UPDATE_QUEUE_DEPTH = REGISTRY.gauge('astrobot_update_queue_depth', "Updates waiting to be processed")
+SCHEDULER_QUEUED = REGISTRY.gauge('astrobot_scheduler_queued', "Readings waiting for a pipeline slot")
+SCHEDULER_REJECTED = REGISTRY.counter('astrobot_scheduler_rejected_total', "Readings refused by the scheduler", ['reason'])
+STARTUP_SECONDS = REGISTRY.gauge('astrobot_startup_seconds', "Seconds from process start to each startup step", ['phase'])
+
+
+class SpanExporter:
+    """Buffers finished spans and appends them as JSON lines to ``path``.
+
+    The file is written from a background task so exporting never blocks a
+    handler.
+    """
+
+    def __init__(self, path, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._task = None
+
+    def export(self, span):
+        self._buffer.append(span)
+
+    def _write(self, spans):
+        with open(self.path, 'a', encoding='utf-8') as spans_file:
+            spans_file.writelines(json.dumps(span, ensure_ascii=False) + '\n' for span in spans)
+
+    async def flush(self):
+        spans, self._buffer = self._buffer, []
+        if spans:
+            try:
+                await asyncio.to_thread(self._write, spans)
+            except OSError as e:
+                logger.error(f"Error exporting {len(spans)} spans: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+
+_exporter = None
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+def set_span_exporter(exporter):
+    global _exporter
+    _exporter = exporter
+
+
+@contextmanager
+def stage(name, **attributes):
+    """Time a pipeline stage: histogram, error counter and an optional span.
+
+    Works in sync and async code (``with stage('llm'): await ...``). Spans
+    opened inside another stage record it as their parent.
+    """
+    parent = _current_span.get()
+    span = {
+        'trace_id': parent['trace_id'] if parent else uuid.uuid4().hex,
+        'span_id': uuid.uuid4().hex[:16],
+        'parent_id': parent['span_id'] if parent else None,
+        'name': name,
+        'start': time.time(),
+        'attributes': attributes,
+    }
+    _current_span.set(span)
+    started = time.perf_counter()
+    status = 'ok'
+    try:
+        yield span
+    except BaseException as e:
+        # Cancellation or an abandoned generator is not an error of the stage
+        if not isinstance(e, (asyncio.CancelledError, GeneratorExit)):
+            status = 'error'
+            ERRORS.inc(stage=name)
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        # set() rather than reset(): a stage may span the yields of an async
+        # generator, which can be finalized in another context
+        _current_span.set(parent)
+        STAGE_SECONDS.observe(duration, stage=name)
+        if _exporter is not None:
+            span['duration'] = duration
+            span['status'] = status
+            _exporter.export(span)
+
+
+class ActiveChats:
+    """Conversations that have not ended, forgetting those idle for more than ``ttl`` seconds.
+
+    Users who just stop answering never reach the end state, so they are
+    evicted whenever the count is read or a chat is touched, even if the
+    metrics are never scraped.
+    """
+
+    def __init__(self, ttl=3600.0):
+        self.ttl = ttl
+        self._last_seen = {}
+
+    def touch(self, key):
+        self._last_seen.pop(key, None)  # Keep the dict ordered from least to most recent
+        self._last_seen[key] = time.monotonic()
+        self.count()
+
+    def discard(self, key):
+        self._last_seen.pop(key, None)
+
+    def count(self):
+        expired = time.monotonic() - self.ttl
+        for key, last_seen in list(self._last_seen.items()):
+            if last_seen > expired:
+                break
+            del self._last_seen[key]
+        return len(self._last_seen)
+
+
+def instrument_handler(state, callback, end_state=-1):
+    """Wrap a conversation handler ``callback(chat, ...)`` with latency, errors and in-flight tracking.
+
+    ``chat.key`` identifies the conversation and ``chat.chat_id`` is recorded
+    on the span, see :class:`conversation.Chat`.
+    """
+    active = instrument_handler.active_chats
+
+    async def wrapper(chat, *args):
+        started = time.perf_counter()
+        with stage(f"handler.{state}", chat_id=chat.chat_id, channel=chat.key[0]):
+            try:
+                result = await callback(chat, *args)
+            finally:
+                HANDLER_SECONDS.observe(time.perf_counter() - started, state=state)
+        if result == end_state:
+            active.discard(chat.key)
+        else:
+            active.touch(chat.key)
+        return result
+
+    wrapper.__name__ = getattr(callback, '__name__', state)
+    return wrapper
+
+
+instrument_handler.active_chats = ActiveChats()
+CONVERSATIONS_IN_FLIGHT.set_function(instrument_handler.active_chats.count)
+
+
+class MetricsServer:
+    """Minimal HTTP server exposing the registry on ``GET /metrics``."""
+
+    def __init__(self, host='127.0.0.1', port=9100, registry=REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"Metrics available on http://{self.host}:{self.port}/metrics")
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.registry.render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per log line, including any ``extra`` fields."""
+
+    RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'sample'}
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update({k: v for k, v in vars(record).items() if k not in self.RESERVED})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        span = _current_span.get()
+        if span is not None:
+            entry['trace_id'] = span['trace_id']
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SampledFilter(logging.Filter):
+    """Let through only a fraction of the records logged with ``extra={'sample': True}``."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if getattr(record, 'sample', False):
+            return random.random() < self.rate
+        return True
+
+
+def setup_logging(filename='bot_activity.log', level=logging.INFO, json_format=False, sample_rate=0.01):
+    handler = logging.FileHandler(filename)
+    if json_format:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    handler.addFilter(SampledFilter(sample_rate))
+    logging.basicConfig(level=level, handlers=[handler])
+
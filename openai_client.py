@@ -0,0 +1,243 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# HTTP status codes worth retrying: rate limiting and transient server errors
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class PredictionError(Exception):
+    """Raised when the chat completions API does not return a usable answer."""
+
+
+@dataclass
+class Completion:
+    content: str
+    usage: dict = field(default_factory=dict)
+    latency: float = 0.0
+    response: dict = field(default_factory=dict)
+    cached: bool = False
+
+
+def _http2_available():
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class PredictionClient:
+    """Shared async client for the OpenAI chat completions endpoint.
+
+    A single pooled ``httpx.AsyncClient`` is reused for every request, the
+    number of requests in flight is bounded by a semaphore and transient
+    failures (429/5xx, timeouts, dropped connections) are retried with
+    exponential backoff and full jitter. ``base_url`` can point to a local
+    stub server for testing. An optional
+    :class:`~prediction_cache.PredictionCache` answers repeated prompts
+    without calling the API and records the usage of the calls that do.
+    ``on_usage(usage, latency, cached)`` is called after every completion,
+    cached or not, e.g. to feed metrics.
+    """
+
+    def __init__(self, api_key, base_url="https://api.openai.com/v1", model="gpt-4o",
+                 timeout=60.0, connect_timeout=10.0, max_concurrency=8,
+                 max_connections=20, max_retries=3, backoff_base=0.5,
+                 backoff_max=20.0, http2=True, transport=None, cache=None, on_usage=None):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.model = model
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections,
+                                   max_keepalive_connections=max_connections)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.http2 = http2
+        self.transport = transport
+        self.cache = cache
+        self.on_usage = on_usage
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._client = None
+
+    def _get_client(self):
+        if self._client is None:
+            http2 = self.http2 and _http2_available()
+            if self.http2 and not http2:
+                logger.warning("HTTP/2 requested but the 'h2' package is not installed, using HTTP/1.1")
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={'Authorization': f'Bearer {self.api_key}'},
+                timeout=self.timeout,
+                limits=self.limits,
+                http2=http2,
+                transport=self.transport,
+            )
+        return self._client
+
+    def _backoff(self, attempt, response=None):
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after:
+                try:
+                    return min(float(retry_after), self.backoff_max)
+                except ValueError:
+                    pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def _post(self, path, payload, stream=False):
+        # With stream=True the caller must close the returned response
+        client = self._get_client()
+        attempt = 0
+        while True:
+            response = None
+            try:
+                request = client.build_request('POST', path, json=payload)
+                response = await client.send(request, stream=stream)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    if response.is_error:
+                        await response.aclose()
+                    response.raise_for_status()
+                    return response
+                await response.aclose()
+                error = httpx.HTTPStatusError(
+                    f"Retryable status {response.status_code}", request=response.request, response=response)
+            except (httpx.TimeoutException, httpx.TransportError) as e:
+                error = e
+            if attempt >= self.max_retries:
+                raise error
+            delay = self._backoff(attempt, response)
+            attempt += 1
+            logger.warning(f"OpenAI request failed ({error}), retry {attempt}/{self.max_retries} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+    def _report_usage(self, usage, latency, cached):
+        if self.on_usage is not None:
+            try:
+                self.on_usage(usage, latency, cached)
+            except Exception as e:
+                logger.error(f"Error in usage callback: {e}")
+
+    async def complete(self, messages):
+        """Send a chat completion request and return a :class:`Completion`."""
+        key = None
+        if self.cache is not None:
+            key = self.cache.make_key(self.model, messages)
+            cached = await asyncio.to_thread(self.cache.get, key)
+            if cached is not None:
+                content, usage = cached
+                self._report_usage(usage, 0.0, True)
+                return Completion(content=content, usage=usage, cached=True)
+        payload = {'model': self.model, 'messages': messages}
+        async with self._semaphore:
+            started = time.perf_counter()
+            response = await self._post('/chat/completions', payload)
+            latency = time.perf_counter() - started
+        data = response.json()
+        try:
+            content = data['choices'][0]['message']['content']
+        except (KeyError, IndexError, TypeError) as e:
+            raise PredictionError(f"Unexpected response format: {e}, content: {data}") from e
+        usage = data.get('usage') or {}
+        if self.cache is not None:
+            await asyncio.to_thread(self.cache.record_usage, self.model, usage, latency)
+            await asyncio.to_thread(self.cache.put, key, self.model, content, usage, latency)
+        self._report_usage(usage, latency, False)
+        return Completion(content=content, usage=usage, latency=latency, response=data)
+
+    async def stream_paragraphs(self, messages):
+        """Stream a chat completion and yield each paragraph once its newline arrives."""
+        key = None
+        if self.cache is not None:
+            key = self.cache.make_key(self.model, messages)
+            cached = await asyncio.to_thread(self.cache.get, key)
+            if cached is not None:
+                self._report_usage(cached[1], 0.0, True)
+                for paragraph in cached[0].split('\n'):
+                    if paragraph.strip():
+                        yield paragraph
+                return
+        payload = {'model': self.model, 'messages': messages, 'stream': True,
+                   'stream_options': {'include_usage': True}}
+        # The stream is read by its own task, which gives the concurrency slot
+        # back as soon as the completion ends, however slowly the caller sends
+        # the paragraphs on
+        queue = asyncio.Queue()
+        producer = asyncio.create_task(self._read_stream(payload, key, queue))
+        try:
+            while True:
+                paragraph = await queue.get()
+                if paragraph is None:
+                    break
+                yield paragraph
+            await producer  # Raises the error that ended the stream, if any
+        finally:
+            if not producer.done():
+                producer.cancel()
+
+    async def _read_stream(self, payload, key, queue):
+        """Put each paragraph of the streamed completion in ``queue``, then None."""
+        parts = []
+        usage = {}
+        try:
+            async with self._semaphore:
+                started = time.perf_counter()
+                response = await self._post('/chat/completions', payload, stream=True)
+                try:
+                    buffer = ''
+                    async for line in response.aiter_lines():
+                        # Server-sent events: one "data: {json}" line per chunk
+                        if not line.startswith('data:'):
+                            continue
+                        data = line[len('data:'):].strip()
+                        if data == '[DONE]':
+                            break
+                        try:
+                            chunk = json.loads(data)
+                        except ValueError as e:
+                            raise PredictionError(f"Invalid stream chunk: {data!r}") from e
+                        if chunk.get('usage'):
+                            usage = chunk['usage']
+                        for choice in chunk.get('choices') or []:
+                            delta = (choice.get('delta') or {}).get('content')
+                            if delta:
+                                parts.append(delta)
+                                buffer += delta
+                        while '\n' in buffer:
+                            paragraph, buffer = buffer.split('\n', 1)
+                            if paragraph.strip():
+                                queue.put_nowait(paragraph)
+                    if buffer.strip():
+                        queue.put_nowait(buffer)
+                finally:
+                    await response.aclose()
+                latency = time.perf_counter() - started
+            if not parts:
+                raise PredictionError("Empty completion stream")
+        finally:
+            queue.put_nowait(None)
+        if self.cache is not None:
+            await asyncio.to_thread(self.cache.record_usage, self.model, usage, latency)
+            await asyncio.to_thread(self.cache.put, key, self.model, ''.join(parts), usage, latency)
+        self._report_usage(usage, latency, False)
+
+    async def warm_up(self):
+        """Open a pooled connection (DNS, TCP, TLS, HTTP/2) with a request that uses no tokens.
+
+        Returns the HTTP status, any answer (even 401) means the connection is up.
+        """
+        response = await self._get_client().get('/models')
+        return response.status_code
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
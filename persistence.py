@@ -0,0 +1,354 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from itertools import islice
+
+logger = logging.getLogger(__name__)
+
+SESSION = 'session'
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+
+
+def _version(data):
+    # Values carry the number of times they were written, see flush()
+    return json.loads(data).get('version', 0) if data else 0
+
+
+def _bump(data, version):
+    return _dumps({**json.loads(data), 'version': version + 1})
+
+
+def new_session():
+    return {'state': None, 'data': {}}
+
+
+class ConversationPersistence:
+    """Session store of the conversation engine, one ``{'state', 'data'}`` per chat.
+
+    Nothing is loaded at startup: the session of a chat is read when its
+    first message arrives, or on every message when ``shared`` so that
+    several processes can serve the same chat. Only sessions whose serialized
+    value changed since they were last read or written are staged, and what
+    is staged is written in one batch ``update_interval`` seconds later (or
+    on :meth:`flush`). This base class keeps sessions in memory only;
+    subclasses implement :meth:`_read` and :meth:`_write` for their storage
+    and keep at most ``cache_size`` sessions in memory, the least recently
+    used first out.
+
+    Every session has a ``version``, bumped on each write. When ``shared``
+    a session is only written if the stored version is still the one it was
+    loaded with (compare-and-set), so two processes answering the same chat
+    at once can not overwrite each other: the second write is refused and
+    reported by :meth:`commit`.
+    """
+
+    persistent = False  # Sessions dropped from memory can be read back
+
+    def __init__(self, update_interval=1.0, shared=False, cache_size=10000):
+        self.update_interval = update_interval
+        self.shared = shared
+        self.cache_size = cache_size
+        self._sessions = OrderedDict()  # (channel, chat_id) -> session, least recently used first
+        self._written = {}  # (kind, name, key) -> JSON last read or written
+        self._pending = {}  # (kind, name, key) -> JSON to write, None to delete
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+
+    async def _read(self, kind, name, key):
+        """Return the stored JSON text, or None."""
+        return None
+
+    async def _write(self, items):
+        """Store ``[((kind, name, key), json_or_None, version), ...]`` in one batch.
+
+        An item with a ``version`` is only written if the stored one still
+        has it (0 when there is none). Returns the items that were not.
+        """
+        return []
+
+    async def close(self):
+        await self.flush()
+        if self._flush_task is not None:
+            self._flush_task.cancel()  # Nothing left for it to write
+
+    async def load(self, channel, chat_id):
+        """Return the session of a chat, a new one if it has none yet."""
+        key = (channel, str(chat_id))
+        item = (SESSION, *key)
+        session = self._sessions.get(key)
+        # Local changes that are not written yet are newer than the store
+        if session is not None and (not self.shared or item in self._pending):
+            self._sessions.move_to_end(key)
+            return session
+        data = await self._read(*item)
+        if data is None:
+            self._written.pop(item, None)
+            session = new_session()
+        else:
+            self._written[item] = data
+            session = json.loads(data)
+        self._cache(key, session)
+        return session
+
+    def save(self, channel, chat_id, session):
+        """Stage the session of a chat to be written with the next batch."""
+        key = (channel, str(chat_id))
+        self._cache(key, session)
+        self._stage((SESSION, *key), session)
+
+    async def commit(self, channel, chat_id, session):
+        """Save the session of a chat and write it now.
+
+        Returns False if another process changed it since it was loaded, in
+        which case the store keeps the other version. A failed write stays
+        staged for the next batch and counts as saved.
+        """
+        self.save(channel, chat_id, session)
+        conflicts = await self.flush()
+        return (SESSION, channel, str(chat_id)) not in conflicts
+
+    def _cache(self, key, session):
+        self._sessions[key] = session
+        self._sessions.move_to_end(key)
+        if not self.persistent:
+            return  # Memory is the only copy
+        excess = len(self._sessions) - self.cache_size
+        for old_key in list(islice(self._sessions, max(excess, 0))):
+            if (SESSION, *old_key) not in self._pending:
+                self._evict(old_key)
+
+    def _evict(self, key):
+        self._sessions.pop(key, None)
+        self._written.pop((SESSION, *key), None)
+
+    def _stage(self, item, value):
+        data = None if value is None else _dumps(value)
+        if data == self._pending.get(item, self._written.get(item, False)):
+            return
+        self._pending[item] = data
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_soon())
+
+    async def _flush_soon(self):
+        # Shared stores are flushed by the engine after every message
+        await asyncio.sleep(0 if self.shared else self.update_interval)
+        await self.flush()
+
+    async def flush(self):
+        """Write what is staged; returns the items refused because another process changed them."""
+        async with self._flush_lock:
+            if not self._pending:
+                return set()
+            batch, self._pending = self._pending, {}
+            items = []
+            for item, data in batch.items():
+                version = _version(data)
+                items.append((item, data and _bump(data, version), version if self.shared else None))
+            try:
+                conflicts = set(await self._write(items))
+            except Exception as e:
+                logger.error(f"Error writing {len(batch)} persistence entries: {e}")
+                for item, data in batch.items():
+                    self._pending.setdefault(item, data)
+                return set()
+            for item, data, version in items:
+                key = item[1:]
+                if item in conflicts:
+                    logger.warning(f"Session {key} was changed by another process, keeping its version")
+                    if item not in self._pending:
+                        self._evict(key)  # Read it again next time
+                    continue
+                if data is None:
+                    self._written.pop(item, None)
+                    continue
+                # Whoever holds the session (a reading in progress) writes the next version
+                session = self._sessions.get(key)
+                if session is not None and session.get('version', 0) == version:
+                    session['version'] = version + 1
+                pending = self._pending.get(item)
+                if pending is not None and _version(pending) == version:
+                    self._pending[item] = _bump(pending, version)
+                if self.shared and self.persistent and item not in self._pending:
+                    # Shared sessions are read again on every message, no point keeping them
+                    self._evict(key)
+                else:
+                    self._written[item] = data
+            return conflicts
+
+
+class SQLitePersistence(ConversationPersistence):
+    """:class:`ConversationPersistence` in a SQLite (WAL) file, shareable by local processes."""
+
+    persistent = True
+
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _get_conn(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS persistence ("
+                "kind TEXT NOT NULL, name TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                "updated_at REAL NOT NULL, PRIMARY KEY (kind, name, key)) WITHOUT ROWID"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def _read_sync(self, kind, name, key):
+        with self._lock:
+            row = self._get_conn().execute(
+                "SELECT value FROM persistence WHERE kind = ? AND name = ? AND key = ?", (kind, name, key)
+            ).fetchone()
+        return row[0] if row else None
+
+    def _write_sync(self, items):
+        now = time.time()
+        conflicts = []
+        with self._lock:
+            conn = self._get_conn()
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO persistence (kind, name, key, value, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    [(*item, data, now) for item, data, version in items if data is not None and version is None],
+                )
+                conn.executemany(
+                    "DELETE FROM persistence WHERE kind = ? AND name = ? AND key = ?",
+                    [item for item, data, version in items if data is None],
+                )
+                for item, data, version in items:
+                    if data is None or version is None:
+                        continue
+                    # Each statement is atomic, the first one also takes the write lock
+                    if version == 0 and conn.execute(
+                            "INSERT OR IGNORE INTO persistence (kind, name, key, value, updated_at) "
+                            "VALUES (?, ?, ?, ?, ?)", (*item, data, now)).rowcount:
+                        continue
+                    if not conn.execute(
+                            "UPDATE persistence SET value = ?, updated_at = ? WHERE kind = ? AND name = ? AND key = ? "
+                            "AND COALESCE(json_extract(value, '$.version'), 0) = ?",
+                            (data, now, *item, version)).rowcount:
+                        conflicts.append(item)
+        return conflicts
+
+    async def _read(self, kind, name, key):
+        return await asyncio.to_thread(self._read_sync, kind, name, key)
+
+    async def _write(self, items):
+        return await asyncio.to_thread(self._write_sync, items)
+
+    async def close(self):
+        await super().close()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class RedisPersistence(ConversationPersistence):
+    """:class:`ConversationPersistence` in Redis (or any server speaking its protocol).
+
+    Each session is a key of its own (``<prefix>:session:<channel>:<chat
+    id>``) and a batch is sent as a single pipeline. When versions have to be
+    checked it is a ``WATCH``/``MULTI`` transaction on the batch's keys only,
+    retried up to ``max_retries`` times with backoff while other writers get
+    in between; what is still unresolved is reported as a conflict. Sessions
+    stored by older versions in one hash per channel are still read.
+    """
+
+    persistent = True
+
+    def __init__(self, url, prefix='astrobot', max_retries=5, retry_backoff=0.01, **kwargs):
+        super().__init__(**kwargs)
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("RedisPersistence needs the 'redis' package") from e
+        self.url = url
+        self.prefix = prefix
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._client = redis.Redis.from_url(url, decode_responses=True)
+        self._watch_error = redis.WatchError
+
+    def _key(self, kind, name, key):
+        return f"{self.prefix}:{kind}:{name}:{key}"
+
+    def _legacy_hash(self, kind, name):
+        return f"{self.prefix}:{kind}:{name}"
+
+    async def _read(self, kind, name, key):
+        pipe = self._client.pipeline(transaction=False)
+        pipe.get(self._key(kind, name, key))
+        pipe.hget(self._legacy_hash(kind, name), key)
+        data, legacy = await pipe.execute()
+        return legacy if data is None else data
+
+    def _queue_writes(self, pipe, items):
+        for item, data, version in items:
+            if data is None:
+                pipe.delete(self._key(*item))
+            else:
+                pipe.set(self._key(*item), data)
+            pipe.hdel(self._legacy_hash(*item[:2]), item[2])
+
+    async def _write(self, items):
+        if all(version is None for item, data, version in items):
+            pipe = self._client.pipeline(transaction=False)
+            self._queue_writes(pipe, items)
+            await pipe.execute()
+            return []
+        async with self._client.pipeline(transaction=True) as pipe:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    # Only a write to one of these sessions in between aborts EXEC
+                    await pipe.watch(*(self._key(*item) for item, data, version in items))
+                    conflicts = []
+                    for item, data, version in items:
+                        if version is not None and _version(await self._current(pipe, item)) != version:
+                            conflicts.append(item)
+                    pipe.multi()
+                    self._queue_writes(pipe, [entry for entry in items if entry[0] not in conflicts])
+                    await pipe.execute()
+                    return conflicts
+                except self._watch_error:
+                    await pipe.reset()
+                    await asyncio.sleep(self.retry_backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+        logger.warning(f"Gave up writing {len(items)} sessions after {self.max_retries} retries")
+        return [item for item, data, version in items if version is not None]
+
+    async def _current(self, pipe, item):
+        data = await pipe.get(self._key(*item))
+        if data is None:
+            data = await pipe.hget(self._legacy_hash(*item[:2]), item[2])
+        return data
+
+    async def close(self):
+        await super().close()
+        await self._client.aclose()
+
+
+def open_persistence(url, **kwargs):
+    """``redis://host:port/db`` (or ``rediss://``, ``unix://``), ``sqlite:path`` or empty for memory only."""
+    if not url:
+        return ConversationPersistence(**kwargs)
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisPersistence(url, **kwargs)
+    path = url[len('sqlite:'):] if url.startswith('sqlite:') else url
+    return SQLitePersistence(path, **kwargs)
@@ -0,0 +1,157 @@
+import hashlib
+import json
+import logging
+import time
+
+from sqlite_store import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+# Default gpt-4o prices in dollars per million tokens
+DEFAULT_PROMPT_PRICE = 2.50
+DEFAULT_COMPLETION_PRICE = 10.00
+
+# Adds the inserted usage to the day's totals when they already exist
+ADD_USAGE = (
+    "ON CONFLICT (day, model, cached) DO UPDATE SET calls = calls + excluded.calls, "
+    "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+    "completion_tokens = completion_tokens + excluded.completion_tokens, latency = latency + excluded.latency"
+)
+
+
+class PredictionCache(SQLiteStore):
+    """Exact-match cache for chat completions with a TTL and usage accounting.
+
+    Entries are keyed on the model, the system prompt and a hash of the
+    rendered user prompt, and stored in SQLite so they survive restarts.
+    The token counts and latency of every real API call and every cache hit
+    are added to running totals per day and model (``usage_daily``), which
+    is what :meth:`report` uses to work out how many dollars and seconds the
+    cache saved.
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS predictions (
+        key TEXT PRIMARY KEY, model TEXT NOT NULL, content TEXT NOT NULL,
+        prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL, latency REAL NOT NULL,
+        created_at REAL NOT NULL, expires_at REAL NOT NULL, last_access REAL NOT NULL,
+        hits INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS predictions_expires_at ON predictions(expires_at);
+    CREATE INDEX IF NOT EXISTS predictions_last_access ON predictions(last_access);
+    CREATE TABLE IF NOT EXISTS usage_daily (
+        day TEXT NOT NULL, model TEXT NOT NULL, cached INTEGER NOT NULL, calls INTEGER NOT NULL,
+        prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL, latency REAL NOT NULL,
+        PRIMARY KEY (day, model, cached)
+    );
+    """
+
+    def __init__(self, path, ttl=7 * 24 * 3600, max_entries=10000,
+                 prompt_price=DEFAULT_PROMPT_PRICE, completion_price=DEFAULT_COMPLETION_PRICE):
+        super().__init__(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.prompt_price = prompt_price
+        self.completion_price = completion_price
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model, messages):
+        """Hash of the model, the system prompt and the rendered prompt."""
+        system = [m['content'] for m in messages if m['role'] == 'system']
+        prompt = [m['content'] for m in messages if m['role'] != 'system']
+        prompt_hash = hashlib.sha256(json.dumps(prompt).encode('utf-8')).hexdigest()
+        return hashlib.sha256(json.dumps([model, system, prompt_hash]).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Return ``(content, usage)`` for a live entry, or None."""
+        now = time.time()
+        with self._lock:
+            conn = self._get_conn()
+            row = conn.execute(
+                "SELECT model, content, prompt_tokens, completion_tokens, latency FROM predictions "
+                "WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            model, content, prompt_tokens, completion_tokens, latency = row
+            usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens}
+            conn.execute(
+                "UPDATE predictions SET hits = hits + 1, last_access = ? WHERE key = ?", (now, key))
+            self._insert_usage(model, usage, latency, cached=True)
+            conn.commit()
+        return content, usage
+
+    def put(self, key, model, content, usage, latency):
+        now = time.time()
+        prompt_tokens = int(usage.get('prompt_tokens', 0))
+        completion_tokens = int(usage.get('completion_tokens', 0))
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute(
+                "INSERT OR REPLACE INTO predictions (key, model, content, prompt_tokens, completion_tokens, "
+                "latency, created_at, expires_at, last_access) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, model, content, prompt_tokens, completion_tokens, latency, now, now + self.ttl, now),
+            )
+            self._evict(now)
+            conn.commit()
+
+    def record_usage(self, model, usage, latency):
+        """Log the token usage and latency of a real API call."""
+        with self._lock:
+            conn = self._get_conn()
+            self._insert_usage(model, usage, latency, cached=False)
+            conn.commit()
+
+    def _insert_usage(self, model, usage, latency, cached):
+        conn = self._get_conn()
+        conn.execute(
+            "INSERT INTO usage_daily (day, model, cached, calls, prompt_tokens, completion_tokens, latency) "
+            "VALUES (?, ?, ?, 1, ?, ?, ?) " + ADD_USAGE,
+            (time.strftime('%Y-%m-%d', time.gmtime()), model, int(cached), int(usage.get('prompt_tokens', 0)),
+             int(usage.get('completion_tokens', 0)), latency),
+        )
+
+    def _migrate(self, conn):
+        # Earlier versions logged one usage row per call, which grew without bound
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'usage'").fetchone() is None:
+            return
+        conn.execute(
+            "INSERT INTO usage_daily (day, model, cached, calls, prompt_tokens, completion_tokens, latency) "
+            "SELECT date(created_at, 'unixepoch'), model, cached, COUNT(*), SUM(prompt_tokens), "
+            "SUM(completion_tokens), SUM(latency) FROM usage WHERE true GROUP BY 1, 2, 3 " + ADD_USAGE
+        )
+        conn.execute("DROP TABLE usage")
+
+    def _evict(self, now):
+        conn = self._get_conn()
+        conn.execute("DELETE FROM predictions WHERE expires_at <= ?", (now,))
+        count = conn.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+        if count > self.max_entries:
+            conn.execute(
+                "DELETE FROM predictions WHERE key IN "
+                "(SELECT key FROM predictions ORDER BY last_access LIMIT ?)", (count - self.max_entries,))
+
+    def _cost(self, prompt_tokens, completion_tokens):
+        return (prompt_tokens * self.prompt_price + completion_tokens * self.completion_price) / 1_000_000
+
+    def report(self):
+        """Spent and saved tokens, dollars and seconds since the cache was created."""
+        query = ("SELECT COALESCE(SUM(calls), 0), COALESCE(SUM(prompt_tokens), 0), "
+                 "COALESCE(SUM(completion_tokens), 0), COALESCE(SUM(latency), 0) FROM usage_daily WHERE cached = ?")
+        with self._lock:
+            conn = self._get_conn()
+            calls, spent_prompt, spent_completion, spent_seconds = conn.execute(query, (0,)).fetchone()
+            hits, saved_prompt, saved_completion, saved_seconds = conn.execute(query, (1,)).fetchone()
+        return {
+            'api_calls': calls,
+            'spent_tokens': spent_prompt + spent_completion,
+            'spent_dollars': round(self._cost(spent_prompt, spent_completion), 4),
+            'spent_seconds': round(spent_seconds, 2),
+            'cache_hits': hits,
+            'saved_tokens': saved_prompt + saved_completion,
+            'saved_dollars': round(self._cost(saved_prompt, saved_completion), 4),
+            'saved_seconds': round(saved_seconds, 2),
+        }
@@ -1,198 +1,201 @@
 #!/usr/bin/env python
+import time
+STARTED = time.monotonic()  # Startup steps and the first reply are timed from here
 import os
 from dotenv import load_dotenv
 import logging
-from telegram import Update, ReplyKeyboardRemove, ReplyKeyboardMarkup, InputFile
-from telegram.ext import Application, CommandHandler, ConversationHandler, MessageHandler, filters, ContextTypes
-from kerykeion import Report, AstrologicalSubject, KerykeionChartSVG
-import requests, asyncio, unicodedata, time
-import cairosvg
+import asyncio
+import multiprocessing
+import signal
+import sys
+from typing import TYPE_CHECKING
+from prediction_cache import PredictionCache
+from charts import make_profile, render_chart_profiles, warm_up as warm_up_chart
+from chart_pool import ChartPool
+from chart_cache import ChartCache
+from interaction_store import InteractionStore
+from gazetteer import load_gazetteer
+from observability import (
+    CACHE_HITS, CACHE_MISSES, CHART_JOBS_IN_FLIGHT, CHART_QUEUE_DEPTH, ERRORS, OPENAI_TOKENS,
+    STAGE_SECONDS, STARTUP_SECONDS,
+    MetricsServer, instrument_handler, SpanExporter, set_span_exporter, setup_logging, stage,
+)
+from persistence import open_persistence
+from batch import parse_args as parse_batch_args, run_batch
+from scheduler import FairScheduler
+from conversation import ConversationEngine
+
+if TYPE_CHECKING:
+    from telegram.ext import Application
+
+# Spawned chart workers import this module again as __mp_main__, so nothing is set up at
+# import time: main(), run_worker() and batch() call open_bot() or open_pipeline(). Telegram
+# and the OpenAI client (httpx) are imported there too, the workers only need charts.py
+IMPORTS_SECONDS = time.monotonic() - STARTED
 
 # Load environment variables
 load_dotenv()
 
-# Enable logging to a file
-logging.basicConfig(filename='bot_activity.log', level=logging.INFO,
-                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Enable logging to a file, as plain text or one JSON object per line (LOG_FORMAT=json).
+# Full API payloads are only logged for a LOG_SAMPLE_RATE fraction of the calls
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.01"))
+LOG_SETTINGS = ('bot_activity.log', logging.INFO, LOG_FORMAT == "json", LOG_SAMPLE_RATE)  # setup_logging() arguments
 logger = logging.getLogger(__name__)
 
-# Constants for conversation stages
-(NAME, YEAR, MONTH, DAY, TIME, LOCATION, COUNTRY_CODE, RESULT, REPEAT) = range(9)
-
 # API keys
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
-# Arrays of main cities
-ARGENTINA_CITIES = ["buenos aires", "cordoba", "rosario", "mendoza", "la plata", "san miguel de tucuman", "mar del plata", "salta", "santa fe", "san juan"]
-SPAIN_CITIES = ["madrid", "barcelona", "valencia", "sevilla", "zaragoza", "malaga", "murcia", "palma", "las palmas", "bilbao"]
-
-def normalize_string(input_str):
-    return ''.join(
-        c for c in unicodedata.normalize('NFD', input_str)
-        if unicodedata.category(c) != 'Mn'
-    ).lower()
-
-# Auxiliary functions
-def strip_leading_zeros(number_str):
-    try:
-        return str(int(number_str))
-    except ValueError:
-        return None
-
-def validate_time(time_str):
-    try:
-        hour, minute = map(int, time_str.split(":"))
-        if 0 <= hour <= 23 and 0 <= minute <= 59:
-            return hour, minute
-        else:
-            return None, None
-    except ValueError:
-        return None, None
-
-def replace_css_variables(svg_content):
-    css_variables = {
-        '--kerykeion-color-black': '#000000',
-        '--kerykeion-color-white': '#ffffff',
-        '--kerykeion-color-neutral-content': '#c8cbd0',
-        '--kerykeion-color-base-content': '#ccd0d4',
-        '--kerykeion-color-primary': '#38bdf8',
-        '--kerykeion-color-secondary': '#818cf8',
-        '--kerykeion-color-accent': '#f471b5',
-        '--kerykeion-color-neutral': '#1e293b',
-        '--kerykeion-color-base-100': '#0f172a',
-        '--kerykeion-color-info': '#0ca5e9',
-        '--kerykeion-color-info-content': '#000000',
-        '--kerykeion-color-success': '#2dd4bf',
-        '--kerykeion-color-warning': '#f4bf50',
-        '--kerykeion-color-error': '#fb7085',
-        '--kerykeion-color-base-200': '#0a1020',
-        '--kerykeion-color-base-300': '#171f2c',
-        '--kerykeion-chart-color-paper-0': '#c8cbd0',
-        '--kerykeion-chart-color-paper-1': '#0f172a',
-        '--kerykeion-chart-color-zodiac-bg-0': '#0a1020',
-        '--kerykeion-chart-color-zodiac-bg-1': '#171f2c',
-        '--kerykeion-chart-color-zodiac-bg-2': '#0a1020',
-        '--kerykeion-chart-color-zodiac-bg-3': '#171f2c',
-        '--kerykeion-chart-color-zodiac-bg-4': '#0a1020',
-        '--kerykeion-chart-color-zodiac-bg-5': '#171f2c',
-        '--kerykeion-chart-color-zodiac-bg-6': '#0a1020',
-        '--kerykeion-chart-color-zodiac-bg-7': '#171f2c',
-        '--kerykeion-chart-color-zodiac-bg-8': '#0a1020',
-        '--kerykeion-chart-color-zodiac-bg-9': '#171f2c',
-        '--kerykeion-chart-color-zodiac-bg-10': '#0a1020',
-        '--kerykeion-chart-color-zodiac-bg-11': '#171f2c',
-        '--kerykeion-chart-color-zodiac-radix-ring-0': '#1e293b',
-        '--kerykeion-chart-color-zodiac-radix-ring-1': '#1e293b',
-        '--kerykeion-chart-color-zodiac-radix-ring-2': '#1e293b',
-        '--kerykeion-chart-color-zodiac-transit-ring-0': '#1e293b',
-        '--kerykeion-chart-color-zodiac-transit-ring-1': '#1e293b',
-        '--kerykeion-chart-color-zodiac-transit-ring-2': '#1e293b',
-        '--kerykeion-chart-color-zodiac-transit-ring-3': '#1e293b',
-        '--kerykeion-chart-color-houses-radix-line': '#ccd0d4',
-        '--kerykeion-chart-color-houses-transit-line': '#ccd0d4',
-        '--kerykeion-chart-color-conjunction': '#2dd4bf',
-        '--kerykeion-chart-color-semi-sextile': '#2dd4bf',
-        '--kerykeion-chart-color-semi-square': '#fb7085',
-        '--kerykeion-chart-color-sextile': '#2dd4bf',
-        '--kerykeion-chart-color-quintile': '#818cf8',
-        '--kerykeion-chart-color-square': '#fb7085',
-        '--kerykeion-chart-color-trine': '#2dd4bf',
-        '--kerykeion-chart-color-sesquiquadrate': '#fb7085',
-        '--kerykeion-chart-color-biquintile': '#818cf8',
-        '--kerykeion-chart-color-quincunx': '#818cf8',
-        '--kerykeion-chart-color-opposition': '#fb7085',
-        '--kerykeion-chart-color-sun': '#f4bf50',
-        '--kerykeion-chart-color-moon': '#818cf8',
-        '--kerykeion-chart-color-mercury': '#38bdf8',
-        '--kerykeion-chart-color-venus': '#f471b5',
-        '--kerykeion-chart-color-mars': '#f4bf50',
-        '--kerykeion-chart-color-jupiter': '#38bdf8',
-        '--kerykeion-chart-color-saturn': '#818cf8',
-        '--kerykeion-chart-color-uranus': '#f471b5',
-        '--kerykeion-chart-color-neptune': '#38bdf8',
-        '--kerykeion-chart-color-pluto': '#818cf8',
-        '--kerykeion-chart-color-mean-node': '#f4bf50',
-        '--kerykeion-chart-color-true-node': '#f4bf50',
-        '--kerykeion-chart-color-chiron': '#818cf8',
-        '--kerykeion-chart-color-first-house': '#f4bf50',
-        '--kerykeion-chart-color-tenth-house': '#f4bf50',
-        '--kerykeion-chart-color-seventh-house': '#f4bf50',
-        '--kerykeion-chart-color-fourth-house': '#f4bf50',
-        '--kerykeion-chart-color-mean-lilith': '#818cf8',
-        '--kerykeion-chart-color-zodiac-icon-0': '#f471b5',
-        '--kerykeion-chart-color-zodiac-icon-1': '#f4bf50',
-        '--kerykeion-chart-color-zodiac-icon-2': '#38bdf8',
-        '--kerykeion-chart-color-zodiac-icon-3': '#818cf8',
-        '--kerykeion-chart-color-zodiac-icon-4': '#f471b5',
-        '--kerykeion-chart-color-zodiac-icon-5': '#f4bf50',
-        '--kerykeion-chart-color-zodiac-icon-6': '#38bdf8',
-        '--kerykeion-chart-color-zodiac-icon-7': '#818cf8',
-        '--kerykeion-chart-color-zodiac-icon-8': '#f471b5',
-        '--kerykeion-chart-color-zodiac-icon-9': '#f4bf50',
-        '--kerykeion-chart-color-zodiac-icon-10': '#38bdf8',
-        '--kerykeion-chart-color-zodiac-icon-11': '#818cf8',
-        '--kerykeion-chart-color-air-percentage': '#38bdf8',
-        '--kerykeion-chart-color-earth-percentage': '#f4bf50',
-        '--kerykeion-chart-color-fire-percentage': '#f471b5',
-        '--kerykeion-chart-color-water-percentage': '#818cf8',
-        '--kerykeion-chart-color-lunar-phase-0': '#000000',
-        '--kerykeion-chart-color-lunar-phase-1': '#ffffff',
-        '--kerykeion-chart-color-house-number': '#ccd0d4'
-    }
-
-    for var, value in css_variables.items():
-        svg_content = svg_content.replace(f"var({var})", value)
-    
-    return svg_content
-
-def create_astrological_chart(name, year, month, day, hour, minute, location, country_code):
-    try:
-        logger.info(f"Creating astrological chart for {name}, {year}-{month}-{day}, {hour}:{minute}, {location}, {country_code}")
-        subject = AstrologicalSubject(
-            name,
-            int(year),
-            int(month),
-            int(day),
-            int(hour),
-            int(minute),
-            location,
-            country_code
-        )
-        report = Report(subject)
-        full_report = report.get_full_report()
-        
-        # Create SVG chart
-        natal_chart = KerykeionChartSVG(subject, theme="dark", chart_language="ES")
-        natal_chart.makeSVG()
-        
-        return format_chart(full_report)
-    except Exception as e:
-        logger.error(f"Error creating astrological chart: {e}")
-        return None
+# OpenAI client settings
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+
+# Opt-in cache of predictions, enabled by setting PREDICTION_CACHE_TTL in seconds
+PREDICTION_CACHE_PATH = os.getenv("PREDICTION_CACHE_PATH", "cache/predictions.sqlite")
+PREDICTION_CACHE_TTL = float(os.getenv("PREDICTION_CACHE_TTL", "0"))
+PREDICTION_CACHE_MAX_ENTRIES = int(os.getenv("PREDICTION_CACHE_MAX_ENTRIES", "10000"))
+OPENAI_PROMPT_PRICE = float(os.getenv("OPENAI_PROMPT_PRICE", "2.50"))  # Dollars per million tokens
+OPENAI_COMPLETION_PRICE = float(os.getenv("OPENAI_COMPLETION_PRICE", "10.00"))
+
+# Stream predictions paragraph by paragraph, keeping a minimum pause in seconds between messages
+PREDICTION_STREAMING = os.getenv("PREDICTION_STREAMING", "1") == "1"
+MESSAGE_MIN_INTERVAL = float(os.getenv("MESSAGE_MIN_INTERVAL", "2"))
+
+# Chart worker pool settings
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", "0")) or os.cpu_count() or 1
+CHART_QUEUE_SIZE = int(os.getenv("CHART_QUEUE_SIZE", "32"))
+CHART_TIMEOUT = float(os.getenv("CHART_TIMEOUT", "60"))
+
+# Cache of finished charts, set CHART_CACHE_MAX_MB=0 to disable it
+CHART_CACHE_PATH = os.getenv("CHART_CACHE_PATH", "cache/charts.sqlite")
+CHART_CACHE_MAX_MB = int(os.getenv("CHART_CACHE_MAX_MB", "256"))
+CHART_THEME = os.getenv("CHART_THEME", "dark")
+
+# Chart images: every reading sends a small preview as a photo and /hd sends the full
+# resolution one as a document. Formats: png (as rendered), png8 (256 colours) or webp.
+# With CHART_HD_EAGER=1 both are rendered in the same job, so /hd is served from the cache
+CHART_PREVIEW = make_profile('preview', os.getenv("CHART_PREVIEW_SCALE", "1.5"), os.getenv("CHART_PREVIEW_FORMAT", "png8"))
+CHART_HD = make_profile('hd', os.getenv("CHART_HD_SCALE", "4"), os.getenv("CHART_HD_FORMAT", "png"))
+CHART_HD_EAGER = os.getenv("CHART_HD_EAGER", "0") == "1"
+
+# Interaction log
+INTERACTIONS_DB_PATH = os.getenv("INTERACTIONS_DB_PATH", "interactions.sqlite")
+
+# Offline gazetteer: bundled cities plus an optional GeoNames dump (e.g. cities15000.txt)
+GAZETTEER_INDEX_PATH = os.getenv("GAZETTEER_INDEX_PATH", "cache/gazetteer.idx")
+GAZETTEER_SOURCES = ["data/cities.tsv"] + [p for p in os.getenv("GAZETTEER_SOURCE", "").split(",") if p]
+GAZETTEER_PREFERRED_COUNTRIES = os.getenv("GAZETTEER_PREFERRED_COUNTRIES", "AR,ES").split(",")
+
+# Prometheus metrics on http://METRICS_HOST:METRICS_PORT/metrics (0 disables it) and
+# optional export of the per-stage spans to a JSON lines file
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+TRACE_FILE = os.getenv("TRACE_FILE")
+# Conversations without a message for this many seconds no longer count as in flight
+CONVERSATION_IDLE_TTL = float(os.getenv("CONVERSATION_IDLE_TTL", "3600"))
+
+# Updates are processed concurrently across chats, one at a time within a chat
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))
+
+# Webhook mode, enabled with WEBHOOK_PORT (long polling otherwise). WEBHOOK_URL is the
+# public URL registered with Telegram; without it the server only takes local POSTs
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "0"))
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "1"))
+WEBHOOK_MAX_PENDING = int(os.getenv("WEBHOOK_MAX_PENDING", "1000"))
+
+# Conversation sessions (state and birth data of each chat) survive restarts in
+# PERSISTENCE_URL, sqlite:<path> or redis://host:port/db, empty to keep them in memory only.
+# Changes are written in batches every PERSISTENCE_FLUSH_INTERVAL seconds, or after every
+# message when several processes share the conversations (PERSISTENCE_SHARED)
+PERSISTENCE_URL = os.getenv("PERSISTENCE_URL", "sqlite:cache/conversations.sqlite")
+PERSISTENCE_FLUSH_INTERVAL = float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", "1"))
+PERSISTENCE_SHARED = os.getenv("PERSISTENCE_SHARED", "1" if WEBHOOK_WORKERS > 1 else "0") == "1"
+# At most this many sessions are kept in memory (sqlite and redis only, in shared mode
+# they are dropped once written). A shared reading holds its chat for up to READING_LEASE
+# seconds, a process that dies meanwhile only blocks the chat until then
+PERSISTENCE_CACHE_SIZE = int(os.getenv("PERSISTENCE_CACHE_SIZE", "10000"))
+READING_LEASE = float(os.getenv("READING_LEASE", "900"))
+
+# Readings (chart + prediction) go through a scheduler: at most SCHEDULER_MAX_CONCURRENT at
+# once, READINGS_PER_USER_PER_HOUR per user (bursts of READINGS_USER_BURST) and
+# READINGS_PER_MINUTE overall (bursts of READINGS_GLOBAL_BURST). Waiting readings are served
+# round-robin across users, PRIORITY_USER_IDS first, then first readings, then repeats.
+# Each webhook worker has its own scheduler: the global limit is split evenly among
+# WEBHOOK_WORKERS, the other limits apply to each worker
+SCHEDULER_MAX_CONCURRENT = int(os.getenv("SCHEDULER_MAX_CONCURRENT", "16"))
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "200"))
+SCHEDULER_MAX_WAIT = float(os.getenv("SCHEDULER_MAX_WAIT", "300"))
+READINGS_PER_USER_PER_HOUR = float(os.getenv("READINGS_PER_USER_PER_HOUR", "10"))
+READINGS_USER_BURST = int(os.getenv("READINGS_USER_BURST", "3"))
+READINGS_PER_MINUTE = float(os.getenv("READINGS_PER_MINUTE", "60"))
+READINGS_GLOBAL_BURST = int(os.getenv("READINGS_GLOBAL_BURST", "20"))
+PRIORITY_USER_IDS = {i.strip() for i in os.getenv("PRIORITY_USER_IDS", "").split(",") if i.strip()}
+
+# WhatsApp through Twilio, enabled with WHATSAPP_PORT. Twilio POSTs incoming messages to
+# WHATSAPP_PUBLIC_URL + WHATSAPP_PATH, signed with TWILIO_AUTH_TOKEN, and the answers are sent
+# from WHATSAPP_FROM (whatsapp:+<number>). Chart images are served to Twilio by the same server,
+# so WHATSAPP_PUBLIC_URL must reach it. TWILIO_API_URL can point to a local stub
+WHATSAPP_PORT = int(os.getenv("WHATSAPP_PORT", "0"))
+WHATSAPP_HOST = os.getenv("WHATSAPP_HOST", "127.0.0.1")
+WHATSAPP_PATH = os.getenv("WHATSAPP_PATH", "/whatsapp")
+WHATSAPP_PUBLIC_URL = os.getenv("WHATSAPP_PUBLIC_URL", "")
+WHATSAPP_FROM = os.getenv("WHATSAPP_FROM")
+TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
+TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
+TWILIO_API_URL = os.getenv("TWILIO_API_URL", "https://api.twilio.com/2010-04-01")
+
+# Warm-up before taking updates, WARMUP lists the steps (empty to skip it): "charts" renders a
+# dummy chart in every chart worker (kerykeion, Swiss Ephemeris files, cairo and its fonts) and
+# "http" opens the connection pool to the OpenAI API. Each step gives up after WARMUP_TIMEOUT
+WARMUP = [step.strip() for step in os.getenv("WARMUP", "charts,http").split(",") if step.strip()]
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "60"))
+
+# Chart pool, caches and OpenAI client shared by the bot and the batch mode, see open_pipeline()
+prediction_cache = None
+prediction_client = None
+chart_pool = None
+chart_cache = None
+
+# The rest of the bot, see open_bot()
+scheduler = None
+sessions = None
+engine = None
+interaction_store = None
+metrics_server = None
+span_exporter = None
+
+# City names are resolved locally, without a GeoNames request. Opened in startup()
+gazetteer = None
+
+# Seconds from process start to the first answered update, see record_first_reply()
+first_reply = None
+
+def record_openai_usage(usage, latency, cached):
+    prompt_tokens = usage.get('prompt_tokens', 0)
+    completion_tokens = usage.get('completion_tokens', 0)
+    if prediction_cache is not None:
+        (CACHE_HITS if cached else CACHE_MISSES).inc(cache='prediction')
+    if not cached:
+        OPENAI_TOKENS.inc(prompt_tokens, kind='prompt')
+        OPENAI_TOKENS.inc(completion_tokens, kind='completion')
+    logger.info(
+        f"OpenAI usage: {prompt_tokens} prompt + {completion_tokens} completion tokens in {latency:.2f}s"
+        f"{' (cached)' if cached else ''}",
+        extra={'model': OPENAI_MODEL, 'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+               'latency': round(latency, 3), 'cached': cached},
+    )
 
-def format_chart(chart):
-    if not chart:
-        return "Error generating astrological chart."
-    
-    part_of_interest = chart.split("Date")[1]
-    lines = part_of_interest.split('\n')
-    formatted_lines = []
-    for line in lines:
-        line = line.replace('+', '-')
-        if '-' in line:
-            line = line[:57]
-        formatted_lines.append(line)
-    return "🌟----------------------------------------🌟\nDate" + '\n'.join(formatted_lines)
-
-def get_astrological_prediction(name, location, chart):
-    try:
-        endpoint = 'https://api.openai.com/v1/chat/completions'
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {OPENAI_API_KEY}'
-        }
-        prompt = f"""
+def build_prediction_messages(name, location, chart):
+    prompt = f"""
         🌟🔮 Eres una astróloga con un gran sentido del humor, conocida por tu sarcasmo y tus bromas sobre los signos zodiacales. Al principio y al final de la lectura te gusta jugar con los tópicos típicos de los signos (Géminis locos, Piscis siempre soñadores y tristes, Virgo obsesionados con el orden, etc.). Pero, en el medio, cuando analizas la carta astral, te vuelves un poco más seria y haces una lectura profunda y precisa basada en los aspectos reales de la carta. Quieres que la persona sienta que la predicción está basada en su signo y en los detalles astrológicos, pero sin perder el toque divertido en los momentos adecuados. Esta mezcla de humor y rigurosidad hazla de manera orgánica, no lo separes en secciones con diferentes títulos.
 
         📜 Aquí tienes la carta astral:
@@ -204,243 +207,388 @@ def get_astrological_prediction(name, location, chart):
         Usa emojis relevantes para cada sección: bromas sarcásticas al principio y al final, y algo más serio en el análisis central. 😜✨🔮
         """
 
-        data = {
-            'model': 'gpt-4o',
-            'messages': [{'role': 'system', 'content': 'Eres una astróloga que mezcla el humor sarcástico y divertido con lecturas serias y profundas de cartas astrales. Alternas entre el sarcasmo y la seriedad para hacer lecturas divertidas y precisas.'},
-                         {'role': 'user', 'content': prompt}]
-        }
-        response = requests.post(endpoint, headers=headers, json=data)
-        response.raise_for_status()  # Raise an exception for HTTP errors
-        prediction_response = response.json()
-        logger.info(f"OpenAI API response: {prediction_response}")
-        content = prediction_response['choices'][0]['message']['content']
-        return content
-    except requests.exceptions.RequestException as e:
+    return [{'role': 'system', 'content': 'Eres una astróloga que mezcla el humor sarcástico y divertido con lecturas serias y profundas de cartas astrales. Alternas entre el sarcasmo y la seriedad para hacer lecturas divertidas y precisas.'},
+            {'role': 'user', 'content': prompt}]
+
+def prediction_error_message(e):
+    import httpx
+    from openai_client import PredictionError
+    if isinstance(e, httpx.HTTPError):
         logger.error(f"Error en la solicitud: {e}")
         return "Error al obtener la predicción astrológica debido a un error en la solicitud."
-    except KeyError as e:
-        logger.error(f"Error de clave: {e}, contenido de la respuesta: {prediction_response}")
+    if isinstance(e, PredictionError):
+        logger.error(f"Error de clave: {e}")
         return "Error al obtener la predicción astrológica debido a un error de clave."
-    except Exception as e:
-        logger.error(f"Error inesperado: {e}")
-        return "Error al obtener la predicción astrológica debido a un error inesperado."
-
-def log_user_interaction(context):
-    with open("users.txt", "a") as file:
-        user_data = context.user_data
-        file.write(f"Name: {user_data.get('name', 'Unknown')}\n")
-        file.write(f"Date: {user_data.get('day', 'DD')}-{user_data.get('month', 'MM')}-{user_data.get('year', 'YYYY')}\n")
-        file.write(f"Time: {user_data.get('hour', 'HH')}:{user_data.get('minute', 'MM')}\n")
-        file.write(f"Location: {user_data.get('location', 'Unknown')}\n")
-        file.write("-------------------------------\n")
-
-# Command handling functions
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    await update.message.reply_text(
-        "✨🌙 ¡Hola, ser cósmico! Soy la A.I.stróloga, y estoy aquí para decirte cosas que ya sabías, pero con estrellas y planetas de fondo. 😜 ¿Cuál es tu nombre?",
-        reply_markup=ReplyKeyboardRemove(),
-    )
-    return NAME
-
-async def name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    name = update.message.text.strip()
-    if len(name) > 40:
-        await update.message.reply_text("😅 Bueno, parece que tu nombre es más largo que una explicación de los retrógrados de Mercurio. ¿Puedes darme uno más corto, porfa?")
-        return NAME
-    context.user_data["name"] = name
-    await update.message.reply_text(f"🌟 Encantada, {name}. Ahora dime, ¿en qué año naciste y te uniste a este hermoso caos cósmico? (Por favor, no me digas que eres de los 2000, ¡me haces sentir vieja!)")
-    return YEAR
-
-
-async def year(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    year = strip_leading_zeros(update.message.text)
-    if year is not None and 1900 <= int(year) <= 2027:
-        context.user_data["year"] = year
-        await update.message.reply_text("📅 ¡Qué interesante! Ahora dime, ¿en qué mes naciste? Pero por favor, no me digas que eres un Cáncer... ¡ya tenemos suficientes emociones por hoy! 😅 [Dame el número del mes del 1 al 12]")
-        return MONTH
-    else:
-        await update.message.reply_text("⏳ Ese año no me suena a uno real, al menos no en esta dimensión. Intenta con otro. Formato AAAA (Ejemplo: 1984)")
-        return YEAR
-
-
-
-async def month(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    month = strip_leading_zeros(update.message.text)
-    if month is not None and 1 <= int(month) <= 12:
-        context.user_data["month"] = month
-        await update.message.reply_text("🌒 ¡Qué bien! Ahora, ¿en qué día decidiste bendecirnos con tu presencia? 😏")
-        return DAY
-    else:
-        await update.message.reply_text("📆 Ese mes no parece válido en mi carta astral. Prueba con otro.")
-        return MONTH
-
-
-async def day(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    day = strip_leading_zeros(update.message.text)
-    if day is not None and 1 <= int(day) <= 31:
-        context.user_data["day"] = day
-        await update.message.reply_text("⏰ ¡Qué intrigante! Y, ¿a qué hora comenzó todo? (Por favor, usa el formato HH:MM, en formato 24h, y espero que no sea la hora de las brujas o algo así). [Ejemplo: 18:35]")
-        return TIME
-    else:
-        await update.message.reply_text("🗓️ ¡Uy! Ese día no es válido en mi calendario cósmico. Prueba con otro.")
-        return DAY
-
-
-async def time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    hour, minute = validate_time(update.message.text)
-    if hour is not None:
-        context.user_data["hour"] = hour
-        context.user_data["minute"] = minute
-        await update.message.reply_text("🌍 Fascinante, ahora dime el lugar de tu aterrizaje en este planeta. (Introduce la ciudad grande más cercana donde naciste!)")
-        return LOCATION
-    else:
-        await update.message.reply_text("⌛ Lo siento, pero ese formato de hora no lo aceptamos en esta parte del universo. Prueba con el formato HH:MM.")
-        return TIME
-
+    logger.error(f"Error inesperado: {e}")
+    return "Error al obtener la predicción astrológica debido a un error inesperado."
 
-async def generate_chart_and_prediction(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def get_astrological_prediction(name, location, chart):
     try:
-        chart = create_astrological_chart(
-            context.user_data["name"],
-            context.user_data["year"],
-            context.user_data["month"],
-            context.user_data["day"],
-            context.user_data["hour"],
-            context.user_data["minute"],
-            context.user_data["location"],
-            context.user_data["country_code"]
-        )
-        if chart:
-            await update.message.reply_text(f"🌌 Un momento que me concentre...")
-            await asyncio.sleep(3)
-            await update.message.reply_text(f"🌌 ¡Aquí está tu carta astral, revelada a mis ojos!\n\n\n{chart}")
-            
-            # Wait for the SVG file to be created
-            await asyncio.sleep(2)
-            
-            # Find and send the SVG file
-            home_dir = os.path.expanduser("~")
-            svg_files = [f for f in os.listdir(home_dir) if f.endswith('.svg')]
-            if svg_files:
-                svg_path = os.path.join(home_dir, svg_files[0])
-                png_path = svg_path.replace('.svg', '.png')
-                
-                # Read SVG content and replace CSS variables
-                with open(svg_path, 'r') as svg_file:
-                    svg_content = svg_file.read()
-                svg_content = replace_css_variables(svg_content)
-                with open(svg_path, 'w') as svg_file:
-                    svg_file.write(svg_content)
-                
-                # Try to convert and send PNG file
-                try:
-                    cairosvg.svg2png(url=svg_path, write_to=png_path, scale=4.0)  # Increase resolution by 4 times
-                    with open(png_path, 'rb') as png_file:
-                        await update.message.reply_document(InputFile(png_file))
-                except Exception as e:
-                    logger.error(f"Error converting or sending PNG file: {e}")
-                    await update.message.reply_text("⚠️ Hubo un problema al convertir o enviar tu carta astral en formato PNG.")
-                
-                # Remove both SVG and PNG files
-                try:
-                    os.remove(svg_path)
-                    os.remove(png_path)
-                except Exception as e:
-                    logger.error(f"Error removing files: {e}")
-            
-            await update.message.reply_text("🔮 Dame un momento mientras consulto las estrellas y tejo tu predicción...")
-            prediction = get_astrological_prediction(context.user_data["name"], context.user_data["location"], chart)
-            
-            await update.message.reply_text("⭐ Con las estrellas como testigo, aquí está tu predicción:")
-            await asyncio.sleep(2)  # 2-second pause for suspense
-
-            prediction_paragraphs = prediction.split('\n')
-            for paragraph in prediction_paragraphs:
-                if paragraph.strip():  # Only send non-empty paragraphs
-                    await update.message.reply_text(paragraph)
-                    await asyncio.sleep(5)  # 5-second pause between paragraphs
-
-            log_user_interaction(context)  # Log the user interaction
-            await asyncio.sleep(8)  # 8-second pause before asking if they want to continue
-            await update.message.reply_text(
-                '🌟 ¡Espero que mis palabras resuenen contigo! ¿Te gustaría seguir preguntando sobre otras almas que deseas conocer más?'
-            )
-            return REPEAT
-        else:
-            error_message = f"Error generating chart for: {context.user_data}"
-            print(error_message)  # Debug print
-            await update.message.reply_text(f"⚠️ Hubo un error al generar tu carta astral. Detalles: {error_message}")
-            return ConversationHandler.END
+        with stage("llm"):
+            completion = await prediction_client.complete(build_prediction_messages(name, location, chart))
+        if not completion.cached:
+            # Sampled, and formatted lazily so dropped records cost nothing
+            logger.info("OpenAI API response: %s", completion.response, extra={'sample': True})
+        return completion.content
     except Exception as e:
-        error_message = f"Exception occurred: {str(e)}\nUser data: {context.user_data}"
-        print(error_message)  # Debug print
-        logger.error(error_message)
-        await update.message.reply_text(f"⚠️ Hubo un error al generar tu carta astral. Detalles: {error_message}")
-        return ConversationHandler.END
-
-async def location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    location = normalize_string(update.message.text.strip())
-    if len(location) <= 50:
-        context.user_data["location"] = location
-        logger.info(f"Location received: {location}")
-        
-        if location in ARGENTINA_CITIES:
-            context.user_data["country_code"] = "AR"
-        elif location in SPAIN_CITIES:
-            context.user_data["country_code"] = "ES"
-        else:
-            await update.message.reply_text("🌍 Mmm, no encuentro tu ciudad en mis estrellas. ¿Puedes indicarme el código de país (por ejemplo, ES para España, AR para Argentina)?")
-            return COUNTRY_CODE
-        
-        return await generate_chart_and_prediction(update, context)
-    else:
-        await update.message.reply_text("🌆 Ese lugar parece un poco largo para mi mapa estelar. ¿Puedes darme una ciudad más principal?")
-        return LOCATION
-
-async def country_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    country_code = update.message.text.strip().upper()
-    if len(country_code) == 2:
-        context.user_data["country_code"] = country_code
-        return await generate_chart_and_prediction(update, context)
-    else:
-        await update.message.reply_text("🌍 Ese código de país no parece válido. Por favor, introduce las dos letras que indican tu país (por ejemplo, ES para España, AR para Argentina).")
-        return COUNTRY_CODE
+        return prediction_error_message(e)
+
+async def stream_astrological_prediction(name, location, chart):
+    # Yield the prediction paragraph by paragraph, as soon as each one is ready
+    if not PREDICTION_STREAMING:
+        prediction = await get_astrological_prediction(name, location, chart)
+        for paragraph in prediction.split('\n'):
+            if paragraph.strip():  # Only send non-empty paragraphs
+                yield paragraph
+        return
+    sent_any = False
+    started = asyncio.get_running_loop().time()
+    try:
+        with stage("llm", streaming=True):
+            async for paragraph in prediction_client.stream_paragraphs(build_prediction_messages(name, location, chart)):
+                if not sent_any:
+                    STAGE_SECONDS.observe(asyncio.get_running_loop().time() - started, stage="llm.first_paragraph")
+                sent_any = True
+                yield paragraph
+    except Exception as e:
+        message = prediction_error_message(e)
+        if not sent_any:
+            yield message
+
+def log_user_interaction(channel, user_id, chat_id, user_data):
+    interaction_store.log(
+        channel=channel,
+        user_id=user_id,
+        chat_id=chat_id,
+        name=user_data.get('name'),
+        birth_date=f"{int(user_data['year']):04d}-{int(user_data['month']):02d}-{int(user_data['day']):02d}",
+        birth_time=f"{int(user_data['hour']):02d}:{int(user_data['minute']):02d}",
+        location=user_data.get('location'),
+        country_code=user_data.get('country_code'),
+    )
 
+async def get_chart_images(user_data, profiles):
+    # Return (chart, {profile name: image}) from the cache, rendering the
+    # missing profiles in the worker pool in a single job
+    chart_args = (
+        user_data["name"],
+        user_data["year"],
+        user_data["month"],
+        user_data["day"],
+        user_data["hour"],
+        user_data["minute"],
+        user_data["location"],
+        user_data["country_code"]
+    )
+    coordinates = user_data.get("coordinates")
+    chart, images, keys = None, {}, {}
+    if chart_cache is not None:
+        for profile in profiles:
+            keys[profile.name] = ChartCache.make_key(*chart_args, profile.scale, CHART_THEME, profile.image_format)
+            with stage("chart.cache", profile=profile.name):
+                cached = await asyncio.to_thread(chart_cache.get, keys[profile.name])
+            if cached is None:
+                CACHE_MISSES.inc(cache='chart')
+                continue
+            CACHE_HITS.inc(cache='chart')
+            chart, images[profile.name] = cached
+    missing = [profile for profile in profiles if profile.name not in images]
+    if not missing:
+        logger.info(f"Chart cache hit ({chart_cache.hits} hits, {chart_cache.misses} misses)")
+        return chart, images
+    with stage("chart", profiles=",".join(profile.name for profile in missing)):
+        chart, rendered, timings = await chart_pool.run(
+            render_chart_profiles, *chart_args, [(p.scale, p.image_format) for p in missing], CHART_THEME, coordinates)
+    # Seconds measured inside the worker, without the pool queueing time
+    STAGE_SECONDS.observe(timings['compute'], stage="chart.compute")
+    if not chart:
+        ERRORS.inc(stage="chart.compute")
+        return None, {}
+    if rendered is None:
+        ERRORS.inc(stage="chart.render")
+        return chart, images
+    for profile, image, seconds in zip(missing, rendered, timings['render']):
+        STAGE_SECONDS.observe(seconds, stage=f"chart.render.{profile.name}")
+        images[profile.name] = image
+        if chart_cache is not None:
+            await asyncio.to_thread(chart_cache.put, keys[profile.name], chart, image)
+    return chart, images
+
+async def get_chart(user_data, profile=CHART_HD):
+    # Return (chart, image) for a single profile
+    chart, images = await get_chart_images(user_data, [profile])
+    return chart, images.get(profile.name)
+
+def resolve_place(location, country_code=None):
+    return gazetteer.resolve(location, country_code)
+
+def record_first_reply() -> None:
+    # Called after every handled message, so the first one has been answered
+    global first_reply
+    if first_reply is None:
+        first_reply = startup_step("first_reply")
+        logger.info(f"First reply {first_reply:.2f}s after start")
+
+def configure_logging() -> None:
+    setup_logging(*LOG_SETTINGS)
+
+def open_pipeline() -> None:
+    # Chart and prediction resources shared by the bot and the batch mode, see release_pipeline()
+    global prediction_cache, prediction_client, chart_pool, chart_cache
+    from openai_client import PredictionClient
+    prediction_cache = PredictionCache(
+        PREDICTION_CACHE_PATH,
+        ttl=PREDICTION_CACHE_TTL,
+        max_entries=PREDICTION_CACHE_MAX_ENTRIES,
+        prompt_price=OPENAI_PROMPT_PRICE,
+        completion_price=OPENAI_COMPLETION_PRICE,
+    ) if PREDICTION_CACHE_TTL > 0 else None
+
+    # Shared connection pool for every prediction request
+    prediction_client = PredictionClient(
+        OPENAI_API_KEY,
+        base_url=OPENAI_BASE_URL,
+        model=OPENAI_MODEL,
+        timeout=OPENAI_TIMEOUT,
+        connect_timeout=OPENAI_CONNECT_TIMEOUT,
+        max_concurrency=OPENAI_MAX_CONCURRENCY,
+        max_retries=OPENAI_MAX_RETRIES,
+        cache=prediction_cache,
+        on_usage=record_openai_usage,
+    )
 
-async def repeat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    response = update.message.text
-    if response.lower().startswith('s'):
-        await update.message.reply_text("🌠 ¡Maravilloso! ¿Cuál es el nombre de esta nueva alma?")
-        return NAME
-    else:
-        await update.message.reply_text("✨ Lamentablemente, nuestros caminos se separan. ¡Espero que nuestros caminos se crucen de nuevo!", reply_markup=ReplyKeyboardRemove())
-        return ConversationHandler.END
+    # Process pool for chart computation and rendering, its workers log to the same file
+    chart_pool = ChartPool(max_workers=CHART_WORKERS, max_queue=CHART_QUEUE_SIZE, timeout=CHART_TIMEOUT,
+                           initializer=setup_logging, initargs=LOG_SETTINGS)
+    chart_cache = ChartCache(CHART_CACHE_PATH, max_bytes=CHART_CACHE_MAX_MB * 1024 * 1024) if CHART_CACHE_MAX_MB > 0 else None
+    CHART_QUEUE_DEPTH.set_function(lambda: chart_pool.queue_depth)
+    CHART_JOBS_IN_FLIGHT.set_function(lambda: chart_pool.in_flight)
+
+def open_bot() -> None:
+    # open_pipeline() plus the conversation engine shared by every channel and its scheduler,
+    # sessions, interaction log and metrics
+    global scheduler, sessions, engine, interaction_store, metrics_server, span_exporter
+    open_pipeline()
+    instrument_handler.active_chats.ttl = CONVERSATION_IDLE_TTL
+    metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+    span_exporter = SpanExporter(TRACE_FILE) if TRACE_FILE else None
+    set_span_exporter(span_exporter)
+
+    scheduler = FairScheduler(
+        max_concurrent=SCHEDULER_MAX_CONCURRENT,
+        user_rate=READINGS_PER_USER_PER_HOUR / 3600,
+        user_burst=READINGS_USER_BURST,
+        global_rate=READINGS_PER_MINUTE / 60,
+        global_burst=READINGS_GLOBAL_BURST,
+        max_queue=SCHEDULER_MAX_QUEUE,
+        max_wait=SCHEDULER_MAX_WAIT,
+    )
+
+    # User interactions are written in batches by a background task
+    interaction_store = InteractionStore(INTERACTIONS_DB_PATH)
+
+    sessions = open_persistence(PERSISTENCE_URL, update_interval=PERSISTENCE_FLUSH_INTERVAL,
+                                shared=PERSISTENCE_SHARED, cache_size=PERSISTENCE_CACHE_SIZE)
+    engine = ConversationEngine(
+        sessions,
+        scheduler,
+        get_chart_images,
+        stream_astrological_prediction,
+        resolve_place,
+        preview=CHART_PREVIEW,
+        hd=CHART_HD,
+        hd_eager=CHART_HD_EAGER,
+        log_interaction=log_user_interaction,
+        message_min_interval=MESSAGE_MIN_INTERVAL,
+        priority_users=PRIORITY_USER_IDS,
+        on_handled=record_first_reply,
+        reading_lease=READING_LEASE,
+    )
 
-async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    await update.message.reply_text("✨ Lamentablemente, nuestros caminos se separan. ¡Espero que nuestros caminos se crucen de nuevo!", reply_markup=ReplyKeyboardRemove())
-    return ConversationHandler.END
+# WhatsApp front end, created in run_worker() when WHATSAPP_PORT is set
+whatsapp = None
+
+def startup_step(phase):
+    # Seconds since the process started, exported as astrobot_startup_seconds{phase}
+    elapsed = asyncio.get_running_loop().time() - STARTED  # The loop clock is time.monotonic()
+    STARTUP_SECONDS.set(round(elapsed, 3), phase=phase)
+    return elapsed
+
+async def warm_up() -> dict:
+    # Run the WARMUP steps at the same time, returns the seconds each successful one took
+    loop = asyncio.get_running_loop()
+    timings = {}
+
+    async def charts():
+        profiles = [CHART_PREVIEW, CHART_HD] if CHART_HD_EAGER else [CHART_PREVIEW]
+        profiles = [(profile.scale, profile.image_format) for profile in profiles]
+        # Submitted together, so the pool starts every worker and each one gets a job
+        await asyncio.gather(*(chart_pool.run(warm_up_chart, profiles, CHART_THEME)
+                               for _ in range(chart_pool.max_workers)))
+
+    async def http():
+        status = await prediction_client.warm_up()
+        logger.info(f"OpenAI API answered the warm-up request with HTTP {status}")
+
+    async def run_step(step, coroutine):
+        started = loop.time()
+        try:
+            await asyncio.wait_for(coroutine, WARMUP_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"Warm-up step {step} failed: {e!r}")
+            return
+        timings[step] = loop.time() - started
+        startup_step(f"warmup.{step}")
+
+    steps = {'charts': charts, 'http': http}
+    for step in WARMUP:
+        if step not in steps:
+            logger.warning(f"Unknown warm-up step {step!r}, expected one of {sorted(steps)}")
+    await asyncio.gather(*(run_step(step, steps[step]()) for step in WARMUP if step in steps))
+    return timings
+
+async def startup(application: "Application") -> None:
+    global gazetteer
+    STARTUP_SECONDS.set(round(IMPORTS_SECONDS, 3), phase="imports")
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    gazetteer = await asyncio.to_thread(
+        load_gazetteer, GAZETTEER_INDEX_PATH, GAZETTEER_SOURCES, GAZETTEER_PREFERRED_COUNTRIES)
+    gazetteer_seconds = loop.time() - started
+    startup_step("gazetteer")
+    await interaction_store.start()
+    if metrics_server is not None:
+        await metrics_server.start()
+    if span_exporter is not None:
+        span_exporter.start()
+    warm_up_timings = await warm_up()
+    ready = startup_step("ready")
+    steps = ", ".join(f"{step} {seconds:.2f}s" for step, seconds in warm_up_timings.items()) or "skipped"
+    logger.info(f"Ready {ready:.2f}s after start: imports {IMPORTS_SECONDS:.2f}s, "
+                f"gazetteer {gazetteer_seconds:.2f}s, warm-up {steps}")
+
+async def shutdown(application: "Application") -> None:
+    await engine.close()
+    await sessions.close()
+    if whatsapp is not None:
+        await whatsapp.aclose()
+    if metrics_server is not None:
+        await metrics_server.close()
+    if span_exporter is not None:
+        await span_exporter.close()
+    await interaction_store.close()
+    await release_pipeline()
+
+async def release_pipeline() -> None:
+    # Chart, prediction and gazetteer resources shared by the bot and the batch mode
+    await prediction_client.aclose()
+    chart_pool.shutdown()
+    if chart_cache is not None:
+        chart_cache.close()
+    if gazetteer is not None:
+        gazetteer.close()
+    if prediction_cache is not None:
+        logger.info(f"Prediction cache report: {prediction_cache.report()}")
+        prediction_cache.close()
+
+def build_application(webhook=False) -> "Application":
+    from telegram.ext import Application
+    from telegram_channel import TelegramChannel
+    from update_processor import PerChatUpdateProcessor
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor(CONCURRENT_UPDATES))
+        .post_init(startup)
+        .post_shutdown(shutdown)
+    )
+    if webhook:
+        builder = builder.updater(None)  # Updates come from WebhookServer
+    application = builder.build()
+    TelegramChannel(application.bot).install(application, engine)
+    return application
+
+def run_worker(index: int) -> None:
+    global whatsapp
+    from webhook import WebhookServer, serve  # aiohttp is only needed by the webhooks
+    open_bot()
+    application = build_application(webhook=bool(WEBHOOK_PORT))
+    servers = []
+    if WEBHOOK_PORT:
+        servers.append(WebhookServer(application, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT,
+                                     reuse_port=WEBHOOK_WORKERS > 1, max_pending=WEBHOOK_MAX_PENDING))
+    if WHATSAPP_PORT and index == 0:
+        # Only in the first worker, which also serves the images its messages link to
+        from whatsapp_channel import WhatsAppChannel, WhatsAppServer
+        whatsapp = WhatsAppChannel(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, WHATSAPP_FROM, WHATSAPP_PUBLIC_URL,
+                                   api_url=TWILIO_API_URL)
+        servers.append(WhatsAppServer(engine, whatsapp, WHATSAPP_PATH, TWILIO_AUTH_TOKEN, WHATSAPP_HOST, WHATSAPP_PORT,
+                                      max_pending=WEBHOOK_MAX_PENDING))
+    if metrics_server is not None:
+        metrics_server.port += index  # One metrics port per worker
+    if WEBHOOK_WORKERS > 1:
+        # Token buckets are per process, each worker takes its share of the global limit
+        rate, burst = READINGS_PER_MINUTE / WEBHOOK_WORKERS, max(1.0, READINGS_GLOBAL_BURST / WEBHOOK_WORKERS)
+        scheduler.set_global_limit(rate / 60, burst)
+        logger.info(f"Worker {index}: at most {rate:g} readings per minute (bursts of {burst:g}), "
+                    f"READINGS_PER_MINUTE split among {WEBHOOK_WORKERS} workers")
+    # Only the first worker registers the webhook with Telegram
+    asyncio.run(serve(application, servers, WEBHOOK_URL if WEBHOOK_PORT and index == 0 else None, WEBHOOK_SECRET))
+
+def start_worker(index: int) -> None:
+    # Entry point of the spawned webhook workers
+    configure_logging()
+    run_worker(index)
 
 def main() -> None:
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
-    conv_handler = ConversationHandler(
-         entry_points=[
-            CommandHandler('start', start),  # Activates with the /start command
-            MessageHandler(filters.TEXT & ~filters.COMMAND, start)  # Activates with any text
-        ],
-        states={
-            NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, name)],
-            YEAR: [MessageHandler(filters.TEXT & ~filters.COMMAND, year)],
-            MONTH: [MessageHandler(filters.TEXT & ~filters.COMMAND, month)],
-            DAY: [MessageHandler(filters.TEXT & ~filters.COMMAND, day)],
-            TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, time)],
-            LOCATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, location)],
-            COUNTRY_CODE: [MessageHandler(filters.TEXT & ~filters.COMMAND, country_code)],
-            REPEAT: [MessageHandler(filters.TEXT & ~filters.COMMAND, repeat)]
-        },
-        fallbacks=[CommandHandler("cancel", cancel)],
-    )
-    application.add_handler(conv_handler)
-    application.run_polling()
+    configure_logging()
+    if not WEBHOOK_PORT and not WHATSAPP_PORT:
+        open_bot()
+        build_application().run_polling()
+        return
+    if WEBHOOK_WORKERS <= 1 or not WEBHOOK_PORT:
+        run_worker(0)
+        return
+    # Workers share the port (SO_REUSEPORT) and the kernel spreads connections among them
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=start_worker, args=(i,)) for i in range(WEBHOOK_WORKERS)]
+    for worker in workers:
+        worker.start()
+    signal.signal(signal.SIGTERM, lambda *_: [worker.terminate() for worker in workers])
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # Ctrl+C reaches the whole process group, wait for the workers to stop
+        for worker in workers:
+            worker.join()
+
+def batch(argv) -> None:
+    args = parse_batch_args(argv)
+    configure_logging()
+    open_pipeline()
+
+    async def predict(name, location, chart):
+        completion = await prediction_client.complete(build_prediction_messages(name, location, chart))
+        return completion.content
+
+    async def run_job():
+        global gazetteer
+        gazetteer = await asyncio.to_thread(
+            load_gazetteer, GAZETTEER_INDEX_PATH, GAZETTEER_SOURCES, GAZETTEER_PREFERRED_COUNTRIES)
+        try:
+            # Keep the pool busy without ever hitting ChartQueueFull
+            return await run_batch(args, get_chart, gazetteer, predict if args.predict else None,
+                                   chart_slots=chart_pool.max_workers + chart_pool.max_queue,
+                                   image_format=CHART_HD.image_format)
+        finally:
+            await release_pipeline()
+
+    progress = asyncio.run(run_job())
+    sys.exit(1 if progress.failed else 0)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if sys.argv[1:2] == ["batch"]:
+        batch(sys.argv[2:])  # python run.py batch births.csv ...
+    else:
+        main()
@@ -0,0 +1,232 @@
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from observability import SCHEDULER_QUEUED, SCHEDULER_REJECTED, stage
+
+logger = logging.getLogger(__name__)
+
+
+class SchedulerFull(Exception):
+    """Raised when a request can not even be queued.
+
+    ``retry_after`` is set, in seconds, when the request was refused because
+    the rate limits would not let it start within ``max_wait``.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Allows ``rate`` requests per second on average and bursts of ``capacity``."""
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready(self, now):
+        self._refill(now)
+        return self.tokens >= 1
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def wait_time(self, now):
+        """Seconds until the next token is available."""
+        self._refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate) if self.rate > 0 else float('inf')
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class FairScheduler:
+    """Admission control for the expensive chart and prediction pipeline.
+
+    A request starts when one of ``max_concurrent`` slots is free and both the
+    user's and the global token bucket have a token. Waiting requests are
+    served by priority tier first (lower is more urgent) and round-robin
+    across users within a tier, so one user asking again and again can not
+    starve the others. Each user may have ``max_pending_per_user`` requests
+    waiting or running and at most ``max_queue`` requests wait in total;
+    beyond that :meth:`slot` raises :class:`SchedulerFull`, as it does right
+    away for a request whose user or global bucket would not have a token
+    before ``max_wait``.
+    """
+
+    def __init__(self, max_concurrent=16, user_rate=1 / 60, user_burst=3, global_rate=1.0, global_burst=20,
+                 max_queue=200, max_pending_per_user=1, max_wait=300.0):
+        self.max_concurrent = max_concurrent
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_queue = max_queue
+        self.max_pending_per_user = max_pending_per_user
+        self.max_wait = max_wait
+        self.running = 0
+        self._global_rate = global_rate
+        self._global_burst = global_burst
+        self._global = None
+        self._users = {}
+        self._pending = {}  # user_id -> requests waiting or running
+        self._tiers = {}  # tier -> OrderedDict(user_id -> deque of futures), in round-robin order
+        self._queued = 0
+        self._timer = None
+        SCHEDULER_QUEUED.set_function(lambda: self._queued)
+
+    def _now(self):
+        return asyncio.get_running_loop().time()
+
+    def set_global_limit(self, rate, burst):
+        """Change the global token bucket, e.g. to this process' share when several run."""
+        self._global_rate = rate
+        self._global_burst = burst
+        self._global = None
+
+    def _user_bucket(self, user_id, now):
+        bucket = self._users.get(user_id)
+        if bucket is None:
+            if len(self._users) > 10000:
+                # Forget users whose bucket refilled, they behave like new ones
+                self._users = {u: b for u, b in self._users.items() if not b.full(now) or u in self._pending}
+            bucket = self._users[user_id] = TokenBucket(self.user_rate, self.user_burst, now)
+        return bucket
+
+    def position(self, user_id):
+        """1-based place in line of the user's next waiting request, None if nothing waits.
+
+        Counts one request per user ahead in the round-robin order, which is
+        exact while users have a single request pending.
+        """
+        ahead = 0
+        for tier in sorted(self._tiers):
+            for queued_user in self._tiers[tier]:
+                if queued_user == user_id:
+                    return ahead + 1
+                ahead += 1
+        return None
+
+    def _enqueue(self, user_id, tier):
+        if self._pending.get(user_id, 0) >= self.max_pending_per_user:
+            SCHEDULER_REJECTED.inc(reason='user_pending')
+            raise SchedulerFull(f"user {user_id} already has {self._pending[user_id]} requests pending")
+        if self._queued >= self.max_queue:
+            SCHEDULER_REJECTED.inc(reason='queue_full')
+            raise SchedulerFull(f"{self._queued} requests already queued")
+        # Queueing a request that is bound to time out only keeps the user waiting
+        now = self._now()
+        wait = max(self._user_bucket(user_id, now).wait_time(now), self._global_bucket(now).wait_time(now))
+        if wait > self.max_wait:
+            SCHEDULER_REJECTED.inc(reason='rate_limited')
+            raise SchedulerFull(f"user {user_id} has no token for {wait:.0f}s", retry_after=wait)
+        future = asyncio.get_running_loop().create_future()
+        self._tiers.setdefault(tier, OrderedDict()).setdefault(user_id, deque()).append(future)
+        self._pending[user_id] = self._pending.get(user_id, 0) + 1
+        self._queued += 1
+        self._dispatch()
+        return future
+
+    def _remove(self, user_id, tier, future):
+        users = self._tiers.get(tier, {})
+        waiters = users.get(user_id)
+        if waiters and future in waiters:
+            waiters.remove(future)
+            self._queued -= 1
+            if not waiters:
+                del users[user_id]
+
+    def _done(self, user_id):
+        self._pending[user_id] -= 1
+        if not self._pending[user_id]:
+            del self._pending[user_id]
+
+    def _global_bucket(self, now):
+        if self._global is None:
+            self._global = TokenBucket(self._global_rate, self._global_burst, now)
+        return self._global
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        now = self._now()
+        self._global_bucket(now)
+        retry = None
+        while self.running < self.max_concurrent and self._queued:
+            if not self._global.ready(now):
+                retry = self._global.wait_time(now)
+                break
+            chosen = None
+            for tier in sorted(self._tiers):
+                users = self._tiers[tier]
+                for user_id in users:
+                    bucket = self._user_bucket(user_id, now)
+                    if bucket.ready(now):
+                        chosen = tier, user_id
+                        break
+                    wait = bucket.wait_time(now)
+                    retry = wait if retry is None else min(retry, wait)
+                if chosen:
+                    break
+            if chosen is None:
+                break
+            tier, user_id = chosen
+            users = self._tiers[tier]
+            waiters = users.pop(user_id)
+            future = waiters.popleft()
+            if waiters:
+                users[user_id] = waiters  # Back of the round-robin order
+            self._queued -= 1
+            self._global.take(now)
+            self._user_bucket(user_id, now).take(now)
+            self.running += 1
+            future.set_result(None)
+            retry = None
+        if retry is not None and self._queued and self.running < self.max_concurrent:
+            self._timer = asyncio.get_running_loop().call_later(retry + 0.001, self._dispatch)
+
+    @asynccontextmanager
+    async def slot(self, user_id, tier=1, on_queued=None):
+        """Hold one pipeline slot, waiting in line first if needed.
+
+        ``on_queued(position)`` is awaited right away when the request has to
+        wait, e.g. to tell the user their place in the queue. Raises
+        :class:`SchedulerFull`, or ``asyncio.TimeoutError`` after ``max_wait``
+        seconds in line.
+        """
+        future = self._enqueue(user_id, tier)
+        try:
+            with stage("scheduler.wait", tier=tier):
+                if not future.done() and on_queued is not None:
+                    try:
+                        await on_queued(self.position(user_id))
+                    except Exception as e:
+                        logger.warning(f"Could not notify user {user_id} of their queue position: {e}")
+                await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except BaseException:
+            if future.done() and not future.cancelled():
+                self._release()  # Granted while we were giving up
+            else:
+                future.cancel()
+                self._remove(user_id, tier, future)
+            self._done(user_id)
+            raise
+        try:
+            yield
+        finally:
+            self._release()
+            self._done(user_id)
+
+    def _release(self):
+        self.running -= 1
+        self._dispatch()
@@ -0,0 +1,43 @@
+import os
+import sqlite3
+import threading
+
+
+class SQLiteStore:
+    """Base class of the caches kept in a SQLite (WAL) file.
+
+    The file and the tables in ``schema`` are created on the first call that
+    needs the connection, so that work happens in whatever thread makes the
+    call instead of in the constructor. Subclasses hold ``self._lock`` while
+    they use :meth:`_get_conn`. The methods are blocking, call them through
+    ``asyncio.to_thread`` from the event loop.
+    """
+
+    schema = ""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _get_conn(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(self.schema)
+            self._migrate(conn)
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _migrate(self, conn):
+        """Update the tables of a file written by an older version, after ``schema`` ran."""
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
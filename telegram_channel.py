@@ -0,0 +1,35 @@
+from functools import partial
+from io import BytesIO
+
+from telegram import InputFile
+from telegram.ext import MessageHandler, filters
+
+from conversation import Channel
+
+
+class TelegramChannel(Channel):
+    """Telegram front end of the conversation engine, on a python-telegram-bot Application."""
+
+    name = 'telegram'
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    def install(self, application, engine):
+        """Hand every text message and command of ``application`` to ``engine``."""
+        application.add_handler(MessageHandler(filters.TEXT, partial(self._handle_update, engine)))
+
+    async def _handle_update(self, engine, update, context):
+        user_id = update.effective_user.id if update.effective_user else None
+        await engine.handle(self, update.effective_chat.id, user_id, update.effective_message.text)
+
+    async def send_text(self, chat_id, text):
+        await self.bot.send_message(chat_id, text)
+
+    async def send_image(self, chat_id, image, filename, caption=None, full_resolution=False):
+        document = InputFile(BytesIO(image), filename=filename)
+        if full_resolution:
+            # As a document Telegram keeps the full resolution
+            await self.bot.send_document(chat_id, document, caption=caption)
+        else:
+            await self.bot.send_photo(chat_id, document, caption=caption)
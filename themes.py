@@ -0,0 +1,195 @@
+import importlib.util
+import json
+import logging
+import os
+import re
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Any CSS variable reference emitted by kerykeion, e.g. var(--kerykeion-color-primary)
+VAR_PATTERN = re.compile(r"var\((--kerykeion-[A-Za-z0-9-]+)\)")
+# Custom property declarations inside a :root { ... } block
+DECLARATION_PATTERN = re.compile(r"(--kerykeion-[A-Za-z0-9-]+)\s*:\s*([^;]+);")
+
+# The palette the bot has always used
+DARK_VARIABLES = {
+    '--kerykeion-color-black': '#000000',
+    '--kerykeion-color-white': '#ffffff',
+    '--kerykeion-color-neutral-content': '#c8cbd0',
+    '--kerykeion-color-base-content': '#ccd0d4',
+    '--kerykeion-color-primary': '#38bdf8',
+    '--kerykeion-color-secondary': '#818cf8',
+    '--kerykeion-color-accent': '#f471b5',
+    '--kerykeion-color-neutral': '#1e293b',
+    '--kerykeion-color-base-100': '#0f172a',
+    '--kerykeion-color-info': '#0ca5e9',
+    '--kerykeion-color-info-content': '#000000',
+    '--kerykeion-color-success': '#2dd4bf',
+    '--kerykeion-color-warning': '#f4bf50',
+    '--kerykeion-color-error': '#fb7085',
+    '--kerykeion-color-base-200': '#0a1020',
+    '--kerykeion-color-base-300': '#171f2c',
+    '--kerykeion-chart-color-paper-0': '#c8cbd0',
+    '--kerykeion-chart-color-paper-1': '#0f172a',
+    '--kerykeion-chart-color-zodiac-bg-0': '#0a1020',
+    '--kerykeion-chart-color-zodiac-bg-1': '#171f2c',
+    '--kerykeion-chart-color-zodiac-bg-2': '#0a1020',
+    '--kerykeion-chart-color-zodiac-bg-3': '#171f2c',
+    '--kerykeion-chart-color-zodiac-bg-4': '#0a1020',
+    '--kerykeion-chart-color-zodiac-bg-5': '#171f2c',
+    '--kerykeion-chart-color-zodiac-bg-6': '#0a1020',
+    '--kerykeion-chart-color-zodiac-bg-7': '#171f2c',
+    '--kerykeion-chart-color-zodiac-bg-8': '#0a1020',
+    '--kerykeion-chart-color-zodiac-bg-9': '#171f2c',
+    '--kerykeion-chart-color-zodiac-bg-10': '#0a1020',
+    '--kerykeion-chart-color-zodiac-bg-11': '#171f2c',
+    '--kerykeion-chart-color-zodiac-radix-ring-0': '#1e293b',
+    '--kerykeion-chart-color-zodiac-radix-ring-1': '#1e293b',
+    '--kerykeion-chart-color-zodiac-radix-ring-2': '#1e293b',
+    '--kerykeion-chart-color-zodiac-transit-ring-0': '#1e293b',
+    '--kerykeion-chart-color-zodiac-transit-ring-1': '#1e293b',
+    '--kerykeion-chart-color-zodiac-transit-ring-2': '#1e293b',
+    '--kerykeion-chart-color-zodiac-transit-ring-3': '#1e293b',
+    '--kerykeion-chart-color-houses-radix-line': '#ccd0d4',
+    '--kerykeion-chart-color-houses-transit-line': '#ccd0d4',
+    '--kerykeion-chart-color-conjunction': '#2dd4bf',
+    '--kerykeion-chart-color-semi-sextile': '#2dd4bf',
+    '--kerykeion-chart-color-semi-square': '#fb7085',
+    '--kerykeion-chart-color-sextile': '#2dd4bf',
+    '--kerykeion-chart-color-quintile': '#818cf8',
+    '--kerykeion-chart-color-square': '#fb7085',
+    '--kerykeion-chart-color-trine': '#2dd4bf',
+    '--kerykeion-chart-color-sesquiquadrate': '#fb7085',
+    '--kerykeion-chart-color-biquintile': '#818cf8',
+    '--kerykeion-chart-color-quincunx': '#818cf8',
+    '--kerykeion-chart-color-opposition': '#fb7085',
+    '--kerykeion-chart-color-sun': '#f4bf50',
+    '--kerykeion-chart-color-moon': '#818cf8',
+    '--kerykeion-chart-color-mercury': '#38bdf8',
+    '--kerykeion-chart-color-venus': '#f471b5',
+    '--kerykeion-chart-color-mars': '#f4bf50',
+    '--kerykeion-chart-color-jupiter': '#38bdf8',
+    '--kerykeion-chart-color-saturn': '#818cf8',
+    '--kerykeion-chart-color-uranus': '#f471b5',
+    '--kerykeion-chart-color-neptune': '#38bdf8',
+    '--kerykeion-chart-color-pluto': '#818cf8',
+    '--kerykeion-chart-color-mean-node': '#f4bf50',
+    '--kerykeion-chart-color-true-node': '#f4bf50',
+    '--kerykeion-chart-color-chiron': '#818cf8',
+    '--kerykeion-chart-color-first-house': '#f4bf50',
+    '--kerykeion-chart-color-tenth-house': '#f4bf50',
+    '--kerykeion-chart-color-seventh-house': '#f4bf50',
+    '--kerykeion-chart-color-fourth-house': '#f4bf50',
+    '--kerykeion-chart-color-mean-lilith': '#818cf8',
+    '--kerykeion-chart-color-zodiac-icon-0': '#f471b5',
+    '--kerykeion-chart-color-zodiac-icon-1': '#f4bf50',
+    '--kerykeion-chart-color-zodiac-icon-2': '#38bdf8',
+    '--kerykeion-chart-color-zodiac-icon-3': '#818cf8',
+    '--kerykeion-chart-color-zodiac-icon-4': '#f471b5',
+    '--kerykeion-chart-color-zodiac-icon-5': '#f4bf50',
+    '--kerykeion-chart-color-zodiac-icon-6': '#38bdf8',
+    '--kerykeion-chart-color-zodiac-icon-7': '#818cf8',
+    '--kerykeion-chart-color-zodiac-icon-8': '#f471b5',
+    '--kerykeion-chart-color-zodiac-icon-9': '#f4bf50',
+    '--kerykeion-chart-color-zodiac-icon-10': '#38bdf8',
+    '--kerykeion-chart-color-zodiac-icon-11': '#818cf8',
+    '--kerykeion-chart-color-air-percentage': '#38bdf8',
+    '--kerykeion-chart-color-earth-percentage': '#f4bf50',
+    '--kerykeion-chart-color-fire-percentage': '#f471b5',
+    '--kerykeion-chart-color-water-percentage': '#818cf8',
+    '--kerykeion-chart-color-lunar-phase-0': '#000000',
+    '--kerykeion-chart-color-lunar-phase-1': '#ffffff',
+    '--kerykeion-chart-color-house-number': '#ccd0d4'
+}
+
+
+class Theme:
+    """A chart palette compiled for single-pass substitution.
+
+    :meth:`apply` rewrites every ``var(--kerykeion-...)`` reference of an SVG
+    in one regex pass instead of one ``str.replace`` scan per variable.
+    References without a value in the palette are left untouched.
+    """
+
+    def __init__(self, name, variables):
+        self.name = name
+        self.variables = _resolve(variables)
+
+    def _replace(self, match):
+        return self.variables.get(match.group(1), match.group(0))
+
+    def apply(self, svg_content):
+        return VAR_PATTERN.sub(self._replace, svg_content)
+
+    @classmethod
+    def from_css(cls, name, css):
+        """Build a theme from a kerykeion style ``:root { --kerykeion-...: value; }`` sheet."""
+        css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+        return cls(name, {var: value.strip() for var, value in DECLARATION_PATTERN.findall(css)})
+
+    @classmethod
+    def from_file(cls, path):
+        path = Path(path)
+        if path.suffix == '.json':
+            with open(path, encoding='utf-8') as theme_file:
+                return cls(path.stem, json.load(theme_file))
+        return cls.from_css(path.stem, path.read_text(encoding='utf-8'))
+
+
+def _resolve(variables):
+    # Inline references between variables, e.g. paper-0: var(--kerykeion-color-neutral-content)
+    resolved = {}
+
+    def resolve(var, seen):
+        if var in resolved:
+            return resolved[var]
+        value = variables[var]
+        if var in seen:
+            return value
+        seen = seen | {var}
+        value = VAR_PATTERN.sub(
+            lambda m: resolve(m.group(1), seen) if m.group(1) in variables else m.group(0), value)
+        resolved[var] = value
+        return value
+
+    for var in variables:
+        resolve(var, frozenset())
+    return resolved
+
+
+def load_themes(directories=()):
+    """Load the built-in dark palette plus every theme file found in ``directories``."""
+    themes = {'dark': Theme('dark', DARK_VARIABLES)}
+    for directory in directories:
+        if not directory or not os.path.isdir(directory):
+            continue
+        for path in sorted(Path(directory).iterdir()):
+            if path.suffix not in ('.css', '.json') or path.stem in themes:
+                continue
+            try:
+                themes[path.stem] = Theme.from_file(path)
+            except (OSError, ValueError) as e:
+                logger.error(f"Error loading chart theme {path}: {e}")
+    return themes
+
+
+def _kerykeion_themes_dir():
+    # kerykeion >= 4.12 ships light, classic and dark-high-contrast stylesheets.
+    # Located without importing it, which takes a while
+    spec = importlib.util.find_spec('kerykeion')
+    if spec is None or not spec.submodule_search_locations:
+        return None
+    return os.path.join(spec.submodule_search_locations[0], 'charts', 'themes')
+
+
+# Loaded once per process. CHART_THEMES_DIR can add palettes (.css or .json files).
+THEMES = load_themes([os.getenv("CHART_THEMES_DIR"), _kerykeion_themes_dir()])
+
+
+def get_theme(name):
+    try:
+        return THEMES[name]
+    except KeyError:
+        logger.warning(f"Unknown chart theme {name!r}, using dark")
+        return THEMES['dark']
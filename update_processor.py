@@ -0,0 +1,53 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from telegram.ext import BaseUpdateProcessor
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates of different chats concurrently, one chat at a time.
+
+    The messages of a conversation must reach the engine in order, so
+    updates of the same chat wait for each other (in arrival order) while up
+    to ``max_concurrent_updates`` chats make progress. An update only takes
+    one of those slots once its chat's turn comes, so a backlog in one busy
+    chat can not hold slots the other chats need.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._chats = {}
+
+    @asynccontextmanager
+    async def _chat_turn(self, update):
+        chat = getattr(update, 'effective_chat', None)
+        if chat is None:
+            yield
+            return
+        entry = self._chats.get(chat.id)
+        if entry is None:
+            entry = self._chats[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chats[chat.id]
+
+    async def process_update(self, update, coroutine):
+        # The base class takes the global slot first and then calls
+        # do_process_update, which would wait for the chat while holding it
+        async with self._chat_turn(update):
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,124 @@
+import asyncio
+import hmac
+import json
+import logging
+import signal
+
+from aiohttp import web
+from telegram import Update
+
+from observability import UPDATE_QUEUE_DEPTH, WEBHOOK_UPDATES
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    """aiohttp server that feeds Telegram webhook updates to an Application.
+
+    Requests must carry the secret token given to ``setWebhook`` in the
+    ``X-Telegram-Bot-Api-Secret-Token`` header. Each update is only parsed and
+    put on ``application.update_queue``, so Telegram gets its answer right
+    away; when more than ``max_pending`` updates are waiting the server
+    answers 503 and Telegram retries later. With ``reuse_port`` several
+    worker processes can listen on the same port behind a reverse proxy.
+    """
+
+    def __init__(self, application, path='/telegram', secret_token=None, host='127.0.0.1', port=8080,
+                 reuse_port=False, max_pending=1000, max_body=1024 * 1024):
+        self.application = application
+        self.path = path
+        self.secret_token = secret_token
+        self.host = host
+        self.port = port
+        self.reuse_port = reuse_port
+        self.max_pending = max_pending
+        self.max_body = max_body
+        self._runner = None
+        if not secret_token:
+            logger.warning("Webhook secret token not set, any request will be accepted")
+        UPDATE_QUEUE_DEPTH.set_function(application.update_queue.qsize)
+
+    def make_app(self):
+        app = web.Application(client_max_size=self.max_body)
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get('/healthz', self.handle_health)
+        return app
+
+    async def handle_update(self, request):
+        if self.secret_token and not hmac.compare_digest(
+                request.headers.get(SECRET_HEADER, ''), self.secret_token):
+            WEBHOOK_UPDATES.inc(status='forbidden')
+            return web.Response(status=403)
+        if self.application.update_queue.qsize() >= self.max_pending:
+            WEBHOOK_UPDATES.inc(status='busy')
+            return web.Response(status=503, headers={'Retry-After': '1'})
+        try:
+            data = await request.json(loads=json.loads)
+            update = Update.de_json(data, self.application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            WEBHOOK_UPDATES.inc(status='invalid')
+            logger.warning(f"Invalid webhook update: {e}")
+            return web.Response(status=400)
+        await self.application.update_queue.put(update)
+        WEBHOOK_UPDATES.inc(status='accepted')
+        return web.Response()
+
+    async def handle_health(self, request):
+        return web.Response(text='ok')
+
+    async def start(self):
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port, reuse_port=self.reuse_port or None)
+        await site.start()
+        logger.info(f"Webhook listening on http://{self.host}:{self.port}{self.path}")
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def serve(application, servers, webhook_url=None, secret_token=None, allowed_updates=None):
+    """Run ``application`` fed by ``servers`` until SIGINT or SIGTERM.
+
+    Follows the same lifecycle as ``Application.run_polling`` (post_init,
+    post_stop and post_shutdown included); an application built with an
+    updater also polls Telegram, e.g. when only the WhatsApp webhook is
+    served. The webhook is registered with Telegram, with ``secret_token``,
+    only when ``webhook_url`` is given, so a local instance can be exercised by POSTing recorded
+    updates to it.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        for server in servers:
+            await server.start()
+        if webhook_url:
+            await application.bot.set_webhook(
+                webhook_url, secret_token=secret_token, allowed_updates=allowed_updates)
+            logger.info(f"Webhook registered at {webhook_url}")
+        if application.updater is not None:
+            await application.updater.start_polling(allowed_updates=allowed_updates)
+        await application.start()
+        await stop.wait()
+    finally:
+        # Stop taking updates first, then let the Application drain its queue
+        for server in servers:
+            await server.close()
+        if application.updater is not None and application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
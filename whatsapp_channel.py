@@ -0,0 +1,201 @@
+"""WhatsApp front end of the conversation engine, through Twilio.
+
+Twilio POSTs every incoming WhatsApp message to :class:`WhatsAppServer`, an
+aiohttp app that checks the request signature, answers right away with an
+empty TwiML response and hands the message to the engine in the background.
+Replies go out through Twilio's Messages REST API, which only takes media by
+URL, so chart images are served to Twilio from short-lived
+``/media/<token>`` URLs on the same server.
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import logging
+import mimetypes
+import os
+import secrets
+import time
+
+import httpx
+from aiohttp import web
+
+from conversation import Channel
+from observability import WHATSAPP_MESSAGES
+
+logger = logging.getLogger(__name__)
+
+TWILIO_API_URL = 'https://api.twilio.com/2010-04-01'
+SIGNATURE_HEADER = 'X-Twilio-Signature'
+MAX_BODY = 1500  # Twilio takes up to 1600 characters, some emoji count twice
+EMPTY_TWIML = '<?xml version="1.0" encoding="UTF-8"?><Response></Response>'
+
+
+def twilio_signature(auth_token, url, params):
+    """The ``X-Twilio-Signature`` of a form POST of ``params`` (key, value pairs) to ``url``."""
+    payload = url + ''.join(key + value for key, value in sorted(params))
+    digest = hmac.new(auth_token.encode('utf-8'), payload.encode('utf-8'), hashlib.sha1).digest()
+    return base64.b64encode(digest).decode('ascii')
+
+
+def split_text(text, limit=MAX_BODY):
+    """Cut ``text`` in pieces of at most ``limit`` characters, at line breaks where possible."""
+    parts, current = [], ''
+    for line in text.split('\n'):
+        while len(line) > limit:
+            if current:
+                parts.append(current)
+                current = ''
+            parts.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            parts.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        parts.append(current)
+    return parts
+
+
+class WhatsAppChannel(Channel):
+    """Sends the engine's answers as WhatsApp messages from ``sender`` (``whatsapp:+14155238886``).
+
+    Chat ids are the ``whatsapp:+<number>`` addresses Twilio gives in
+    ``From``. ``public_url`` is where Twilio reaches :class:`WhatsAppServer`;
+    images stay available there for ``media_ttl`` seconds.
+    """
+
+    name = 'whatsapp'
+
+    def __init__(self, account_sid, auth_token, sender, public_url, media_ttl=600.0,
+                 api_url=TWILIO_API_URL, timeout=30.0):
+        self.sender = sender
+        self.public_url = public_url.rstrip('/')
+        self.media_ttl = media_ttl
+        self._client = httpx.AsyncClient(
+            base_url=f"{api_url.rstrip('/')}/Accounts/{account_sid}",
+            auth=(account_sid, auth_token),
+            timeout=timeout,
+        )
+        self._media = {}  # token -> (expires, content type, image)
+
+    async def _send(self, chat_id, **fields):
+        response = await self._client.post('/Messages.json', data={'From': self.sender, 'To': chat_id, **fields})
+        response.raise_for_status()
+
+    async def send_text(self, chat_id, text):
+        for part in split_text(text):
+            await self._send(chat_id, Body=part)
+
+    async def send_image(self, chat_id, image, filename, caption=None, full_resolution=False):
+        # WhatsApp has no uncompressed image messages, full_resolution is ignored
+        fields = {'MediaUrl': self.add_media(image, filename)}
+        if caption:
+            fields['Body'] = caption
+        await self._send(chat_id, **fields)
+
+    def add_media(self, image, filename):
+        """Keep ``image`` for Twilio to fetch and return its URL."""
+        now = time.monotonic()
+        self._media = {token: media for token, media in self._media.items() if media[0] > now}
+        token = secrets.token_urlsafe(16)
+        content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        self._media[token] = (now + self.media_ttl, content_type, image)
+        return f"{self.public_url}/media/{token}{os.path.splitext(filename)[1]}"
+
+    def get_media(self, token):
+        """Return ``(content_type, image)``, or None once it expired."""
+        media = self._media.get(token)
+        if media is None or media[0] <= time.monotonic():
+            return None
+        return media[1:]
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+class WhatsAppServer:
+    """aiohttp server for Twilio's WhatsApp webhook and the media it fetches.
+
+    When ``auth_token`` is set, requests must carry a valid
+    ``X-Twilio-Signature`` for ``channel.public_url + path``. When more than
+    ``max_pending`` messages are being handled the server answers 503 and
+    Twilio retries later.
+    """
+
+    def __init__(self, engine, channel, path='/whatsapp', auth_token=None, host='127.0.0.1', port=8081,
+                 max_pending=1000, max_body=64 * 1024):
+        self.engine = engine
+        self.channel = channel
+        self.path = path
+        self.auth_token = auth_token
+        self.host = host
+        self.port = port
+        self.max_pending = max_pending
+        self.max_body = max_body
+        self._runner = None
+        self._tasks = set()
+        if not auth_token:
+            logger.warning("Twilio auth token not set, any WhatsApp request will be accepted")
+
+    def make_app(self):
+        app = web.Application(client_max_size=self.max_body)
+        app.router.add_post(self.path, self.handle_message)
+        app.router.add_get('/media/{name}', self.handle_media)
+        app.router.add_get('/healthz', self.handle_health)
+        return app
+
+    def _url(self, request):
+        # Behind a proxy the URL Twilio signed is the public one
+        return f"{self.channel.public_url}{self.path}" if self.channel.public_url else str(request.url)
+
+    async def handle_message(self, request):
+        form = await request.post()
+        if self.auth_token and not hmac.compare_digest(
+                request.headers.get(SIGNATURE_HEADER, ''),
+                twilio_signature(self.auth_token, self._url(request), form.items())):
+            WHATSAPP_MESSAGES.inc(status='forbidden')
+            return web.Response(status=403)
+        if len(self._tasks) >= self.max_pending:
+            WHATSAPP_MESSAGES.inc(status='busy')
+            return web.Response(status=503, headers={'Retry-After': '1'})
+        sender = form.get('From')
+        if not sender:
+            WHATSAPP_MESSAGES.inc(status='invalid')
+            return web.Response(status=400)
+        task = asyncio.create_task(self._handle(sender, form.get('WaId') or sender, form.get('Body', '')))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        WHATSAPP_MESSAGES.inc(status='accepted')
+        return web.Response(text=EMPTY_TWIML, content_type='text/xml')
+
+    async def _handle(self, chat_id, user_id, text):
+        try:
+            await self.engine.handle(self.channel, chat_id, user_id, text)
+        except Exception as e:
+            logger.error(f"Error handling WhatsApp message from {chat_id}: {e}")
+
+    async def handle_media(self, request):
+        media = self.channel.get_media(os.path.splitext(request.match_info['name'])[0])
+        if media is None:
+            return web.Response(status=404)
+        content_type, image = media
+        return web.Response(body=image, content_type=content_type)
+
+    async def handle_health(self, request):
+        return web.Response(text='ok')
+
+    async def start(self):
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        logger.info(f"WhatsApp webhook listening on http://{self.host}:{self.port}{self.path}")
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        # Let the messages already accepted get their answer
+        await asyncio.gather(*self._tasks, return_exceptions=True)